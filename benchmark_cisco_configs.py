@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the keyword-dispatch Cisco config parser in parse_cisco_configs.py
+against the regex-per-line parser it replaced
+
+Both parse the same configs, given as files or generated to look like a
+large core switch: SVIs with descriptions, HSRP, helpers and secondary
+addresses, routed ports, dot1Q subinterfaces and many switchports. Lines
+per second of each are reported, along with any VLAN the two parse
+differently.
+"""
+
+import argparse
+import ipaddress
+import re
+import statistics
+import time
+
+import parse_cisco_configs
+
+
+def baseline_parse_vlans(config, site, device):
+    """
+    The regex-per-line parser parse_cisco_configs.parse_vlans replaced,
+    kept as the baseline it is measured against
+    Example config section:
+        interface TenGigabitEthernet6/5
+         description rtr-example-xe-0-3-6
+         ip address 198.51.100.1 255.255.255.254
+         ipv6 address 2001:db8:dead::beef/127
+        !
+        interface Vlan60
+         description another-example
+         ip address 192.0.2.1 255.255.255.192
+         ipv6 address 2001:db8:beef:dead::1/64
+        !
+    """
+    # setup regex
+    re_vid = re.compile(r'^\s*interface Vlan(?P<vid>\d+)$')
+    #re_interface = re.compile(r'^\s*interface (?P<interface>(Loopback|FastEthernet|GigabitEthernet|TenGigabitEthernet)[0-9/]+)$')
+    re_desc = re.compile(r'^\s*description (?P<desc>[\w./-]+)$')
+    re_ipv4 = re.compile(r'^\s*ip address (?P<address>[0-9.]+) (?P<netmask>[0-9.]+)$')
+    re_ipv6 = re.compile(r'^\s*ipv6 address (?P<address>[0-9A-Fa-f:/]+)$')
+    re_end = re.compile(r'^\s*!$')
+    re_blank = re.compile(r'^\s*$')
+
+    # flag if in vlan block
+    vlan_block = False
+
+    # create empty dict for scoping issues
+    vlan = dict()
+    vlans = list()
+    for line in config:
+        # skip blank lines
+        if re_blank.match(line):
+            continue
+
+        # reset vlan block flag and continue
+        if re_end.match(line):
+            vlan_block = False
+            continue
+
+        # check if opening new unit block
+        if re_vid.match(line):
+            # set flag that we've entered a vlan block
+            vlan_block = True
+            # in a new unit block, pull out vlan id
+            vid = re_vid.match(line).group('vid')
+            name = '{device}-v{vid}'.format(
+                device=device,
+                vid=vid,
+            )
+            # store known information in new dict
+            vlan = {
+                'site': site.upper(),
+                'group_name': device,
+                'vid': vid,
+                'name': name,
+                'tenant': '',
+                'status': 'Active',
+                'role': '',
+            }
+            # add new dict to list
+            vlans.append(vlan)
+
+        # only want to check the following when in a vlan block
+        if vlan_block:
+            # check if setting description
+            if re_desc.match(line):
+                vlan['description'] = re_desc.match(line).group('desc')
+            # check if setting address
+            elif re_ipv4.match(line):
+                address = re_ipv4.match(line).group('address')
+                netmask = re_ipv4.match(line).group('netmask')
+                try:
+                    ip_info = ipaddress.ip_interface(
+                        '{address}/{netmask}'.format(
+                            address=address,
+                            netmask=netmask,
+                        )
+                    )
+                    vlan['ipv4_network'] = str(ip_info.network)
+                    vlan['ipv4_gateway'] = ip_info.with_prefixlen
+                except ValueError as e:
+                    raise ValueError(
+                        'Exception converting {address}/{netmask} to IP: {error}'.format(
+                            address=address,
+                            netmask=netmask,
+                            error=e,
+                        )
+                    )
+            elif re_ipv6.match(line):
+                address = re_ipv6.match(line).group('address')
+                try:
+                    ip_info = ipaddress.ip_interface(address)
+                    vlan['ipv6_network'] = str(ip_info.network)
+                    vlan['ipv6_gateway'] = ip_info.with_prefixlen
+                except ValueError as e:
+                    raise ValueError(
+                        'Exception converting {address} to IP: {error}'.format(
+                            address=address,
+                            error=e,
+                        )
+                    )
+    return vlans
+
+
+def generate_config(svis, ports):
+    """
+    Lines of a core switch config with svis SVIs and ports interfaces,
+    a tenth of them routed, a tenth split into dot1Q subinterfaces and the
+    rest switchports
+    """
+    lines = ['hostname bench-core01\n', '!\n']
+    for vid in range(1, svis + 1):
+        network = ipaddress.ip_network('10.0.0.0/8').network_address + vid * 256
+        lines += [
+            'interface Vlan{vid}\n'.format(vid=vid),
+            ' description svi-{vid}\n'.format(vid=vid),
+            ' ip address {address} 255.255.255.192\n'.format(address=network + 1),
+            ' ip helper-address 192.0.2.10\n',
+            ' ip helper-address 192.0.2.11\n',
+            ' no ip redirects\n',
+            ' no ip unreachables\n',
+            ' ip pim sparse-mode\n',
+            ' standby version 2\n',
+            ' standby {vid} ip {address}\n'.format(vid=vid, address=network + 3),
+            ' standby {vid} priority 110\n'.format(vid=vid),
+            ' standby {vid} preempt\n'.format(vid=vid),
+            ' ipv6 address 2001:db8:{vid:x}::1/64\n'.format(vid=vid),
+        ]
+        if vid % 4 == 0:
+            lines.append(' ip address {address} 255.255.255.192 secondary\n'.format(address=network + 65))
+        lines.append('!\n')
+
+    for port in range(ports):
+        name = 'TenGigabitEthernet{slot}/{port}'.format(slot=port // 48 + 1, port=port % 48 + 1)
+        network = ipaddress.ip_network('172.16.0.0/12').network_address + port * 8
+        if port % 10 == 0:
+            lines += [
+                'interface {name}\n'.format(name=name),
+                ' description uplink-{port}\n'.format(port=port),
+                ' no switchport\n',
+                ' ip address {address} 255.255.255.254\n'.format(address=network),
+                ' ip ospf network point-to-point\n',
+                ' ip ospf cost 10\n',
+                '!\n',
+            ]
+        elif port % 10 == 1:
+            lines += [
+                'interface {name}\n'.format(name=name),
+                ' no switchport\n',
+                ' no ip address\n',
+                '!\n',
+                'interface {name}.{vid}\n'.format(name=name, vid=3000 + port % 1000),
+                ' encapsulation dot1Q {vid}\n'.format(vid=3000 + port % 1000),
+                ' ip address {address} 255.255.255.248\n'.format(address=network),
+                '!\n',
+            ]
+        else:
+            lines += [
+                'interface {name}\n'.format(name=name),
+                ' description access-{port}\n'.format(port=port),
+                ' switchport access vlan {vid}\n'.format(vid=port % max(svis, 1) + 1),
+                ' switchport mode access\n',
+                ' spanning-tree portfast\n',
+                ' spanning-tree bpduguard enable\n',
+                '!\n',
+            ]
+    lines.append('end\n')
+    return lines
+
+
+def measure(parse, lines, repeat):
+    """
+    Median seconds of repeat runs of parse over lines, and its rows
+    """
+    runs = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = parse(lines, 'bench', 'bench-core01')
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs), rows
+
+
+def differences(baseline, rows):
+    """
+    VLANs the baseline parsed that the keyword parser parses differently,
+    comparing the fields the baseline fills
+    """
+    parsed = {row['vid']: row for row in rows if row['interface'].startswith('Vlan')}
+    different = list()
+    for row in baseline:
+        other = parsed.get(row['vid'], {})
+        if any(other.get(field) != value for field, value in row.items()):
+            different.append(row['vid'])
+    return different
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Cisco config parsers in lines per second',
+    )
+    parser.add_argument(
+        'configs',
+        nargs='*',
+        help='configs to parse, instead of a generated one',
+    )
+    parser.add_argument(
+        '--svis',
+        type=int,
+        default=4000,
+        help='SVIs in the generated config',
+    )
+    parser.add_argument(
+        '--ports',
+        type=int,
+        default=2000,
+        help='physical interfaces in the generated config',
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        type=int,
+        default=5,
+        help='runs of each parser, the median is reported',
+    )
+    args = parser.parse_args()
+
+    if args.configs:
+        lines = list()
+        for path in args.configs:
+            with open(path, 'r') as infile:
+                lines.extend(infile.readlines())
+    else:
+        lines = generate_config(args.svis, args.ports)
+
+    baseline_seconds, baseline = measure(baseline_parse_vlans, lines, args.repeat)
+    seconds, rows = measure(parse_cisco_configs.parse_vlans, lines, args.repeat)
+    for label, elapsed, parsed in (('regex per line', baseline_seconds, baseline), ('keyword dispatch', seconds, rows)):
+        print(
+            '{label}: {lines:,} lines in {seconds:.3f}s, {rate:,.0f} lines/s, {rows:,} rows'.format(
+                label=label,
+                lines=len(lines),
+                seconds=elapsed,
+                rate=len(lines) / elapsed if elapsed else 0,
+                rows=len(parsed),
+            )
+        )
+    print('speedup: {speedup:.2f}x'.format(speedup=baseline_seconds / seconds if seconds else 0))
+
+    different = differences(baseline, rows)
+    if different:
+        print('VLANs parsed differently: {vids}'.format(vids=', '.join(different)))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
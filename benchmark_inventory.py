@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark netbox_inventory.py end to end against a local stub of the
+NetBox API and a stub resolver
+
+The stub serves generated devices and VMs with NetBox's paging, a fixed
+latency per request and its last_updated__gte, brief and id filters. The
+stub resolver answers after a fixed latency, resolving each hostname under
+one of the inventory's domains and failing a given share of them outright.
+Each scenario runs in a fresh process so its peak memory stands alone, and
+its wall time, requests, DNS lookups and peak RSS are appended as JSON lines
+to a results file and compared with the last run of the same scenario.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+import metrics
+import netbox_inventory
+
+
+# scenarios, each run in its own process
+TARGETS = ['retrieve_devices', 'retrieve_vms', 'main', 'main_warm']
+
+# page size NetBox falls back to without a limit, and the most it returns
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# when every stub object was last updated, before any sync could start
+LAST_UPDATED = '2020-01-01T00:00:00+00:00'
+
+
+def stub_objects(path, sites, count):
+    """
+    Generated objects of one kind spread evenly over sites, by site
+    A third of the names are marked as testing and a third as development,
+    and every fiftieth host is an appliance
+    """
+    role_field = netbox_inventory.ROLE_FIELDS[path]
+    kind = netbox_inventory.KINDS[path]
+    objects = {site: list() for site in sites}
+    for index in range(count):
+        site = sites[index % len(sites)]
+        objects[site].append({
+            'id': index + 1,
+            'name': '{site}{environment}-{kind}{index:06d}'.format(
+                site=site,
+                environment=('app', 'tst', 'dev')[index % 3],
+                kind=kind,
+                index=index,
+            ),
+            'site': {'slug': site, 'name': site.upper()},
+            role_field: {'slug': 'appliance', 'name': 'Appliance'} if index % 50 == 0 else {'slug': 'server', 'name': 'Server'},
+            'tenant': None,
+            'platform': {'slug': 'red-hat-enterprise-linux-7-64-bit', 'name': 'RHEL 7'},
+            'status': {'value': 1, 'label': 'Active'},
+            'primary_ip': None,
+            'tags': [],
+            'last_updated': LAST_UPDATED,
+        })
+    return objects
+
+
+class StubNetBox(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP server answering the device and VM lists the inventory
+    queries
+    """
+
+    daemon_threads = True
+
+    def __init__(self, devices, vms, latency=0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.objects = {
+            netbox_inventory.DEVICES_PATH: stub_objects(netbox_inventory.DEVICES_PATH, netbox_inventory.DEVICE_SITES, devices),
+            netbox_inventory.VMS_PATH: stub_objects(netbox_inventory.VMS_PATH, netbox_inventory.VM_SITES, vms),
+        }
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.server_port)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        by_site = self.server.objects.get(url.path)
+        if by_site is None:
+            self.send_body(404, {'detail': 'Not found.'})
+            return
+
+        sites = query.get('site') or list(by_site)
+        objects = [host for site in sites for host in by_site.get(site, ())]
+        if 'last_updated__gte' in query:
+            since = query['last_updated__gte'][0]
+            objects = [host for host in objects if host['last_updated'] >= since]
+        if 'id' in query:
+            ids = {int(host_id) for host_id in query['id']}
+            objects = [host for host in objects if host['id'] in ids]
+        if 'brief' in query:
+            objects = [{'id': host['id'], 'name': host['name']} for host in objects]
+
+        limit = int(query.get('limit', [DEFAULT_PAGE_SIZE])[0]) or MAX_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        offset = int(query.get('offset', [0])[0])
+        following = None
+        if offset + limit < len(objects):
+            query['limit'] = [str(limit)]
+            query['offset'] = [str(offset + limit)]
+            following = '{url}{path}?{query}'.format(
+                url=self.server.url,
+                path=url.path,
+                query=urllib.parse.urlencode(query, doseq=True),
+            )
+        self.send_body(200, {
+            'count': len(objects),
+            'next': following,
+            'previous': None,
+            'results': objects[offset:offset + limit],
+        })
+
+    def send_body(self, status, document):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_resolves(fqdn, domains, failure_rate):
+    """
+    Whether the stub resolver resolves a name: each hostname under one of
+    the domains, except for failure_rate of them that resolve under none
+    """
+    hostname, _, _ = fqdn.partition('.')
+    checksum = zlib.crc32(hostname.encode())
+    if checksum % 10000 < failure_rate * 10000:
+        return False
+    return fqdn == hostname + domains[checksum // 10000 % len(domains)]
+
+
+class StubResolver(netbox_inventory.Resolver):
+    """
+    Resolver answering from stub_resolves after a fixed latency instead of
+    asking DNS
+    """
+
+    latency = 0.0
+    failure_rate = 0.0
+
+    async def lookup(self, fqdn):
+        async with self.semaphore:
+            with metrics.call('dns'):
+                await asyncio.sleep(self.latency)
+        return stub_resolves(fqdn, self.domains, self.failure_rate)
+
+
+def count_hosts(path):
+    """
+    Distinct hosts in an INI inventory, leaving out the child groups listed
+    """
+    hosts = set()
+    children = False
+    with open(path) as infile:
+        for line in infile:
+            line = line.strip()
+            if line.startswith('['):
+                children = line.endswith(':children]')
+            elif line and not children:
+                hosts.add(line)
+    return len(hosts)
+
+
+def run_scenario(task):
+    """
+    Run one scenario in a worker process and measure it
+    """
+    target, url, options = task
+    StubResolver.latency = options['dns_latency']
+    StubResolver.failure_rate = options['dns_failure_rate']
+    # main builds its resolver itself
+    netbox_inventory.Resolver = StubResolver
+    baseline = metrics.peak_rss()
+
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # main writes its caches and hosts.netbox in the working directory
+        os.chdir(directory)
+        argv = [
+            'netbox_inventory.py',
+            '--url', url,
+            '--token', 'benchmark',
+            '--page_size', str(options['page_size']),
+            '--http_workers', str(options['http_workers']),
+            '--dns_workers', str(options['dns_workers']),
+        ]
+        if target == 'main_warm':
+            # measure a run with the DNS and object caches of an earlier one
+            sys.argv = argv
+            netbox_inventory.main()
+        current = metrics.reset()
+
+        start = time.perf_counter()
+        if target in ('main', 'main_warm'):
+            sys.argv = argv
+            netbox_inventory.main()
+            hosts = count_hosts('hosts.netbox')
+        else:
+            client = netbox_inventory.NetBoxClient(url, 'benchmark', workers=options['http_workers'])
+            resolver = StubResolver(workers=options['dns_workers'])
+            if target == 'retrieve_devices':
+                retrieve, sites = netbox_inventory.retrieve_devices, netbox_inventory.DEVICE_SITES
+            else:
+                retrieve, sites = netbox_inventory.retrieve_vms, netbox_inventory.VM_SITES
+            try:
+                hosts = sum(len(retrieve(client, site, resolver, options['page_size'])) for site in sites)
+            finally:
+                client.close()
+        seconds = time.perf_counter() - start
+        os.chdir(previous)
+
+    calls = current.report()['calls']
+    return {
+        'seconds': seconds,
+        'hosts': hosts,
+        'http_calls': calls.get('http', {}).get('count', 0),
+        'dns_lookups': calls.get('dns', {}).get('count', 0),
+        'baseline_rss_kb': baseline,
+        'peak_rss_kb': metrics.peak_rss(),
+    }
+
+
+def git_commit():
+    """
+    Short hash of the checked out commit, or None outside a git checkout
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            universal_newlines=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(path):
+    """
+    The last result recorded for each scenario and its options
+    """
+    previous = dict()
+    try:
+        with open(path, 'r') as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                    previous[record['target'], json.dumps(record['options'], sort_keys=True)] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def change(value, before):
+    if not before:
+        return ''
+    return ' ({change:+.1%})'.format(change=value / before - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark netbox_inventory.py against a local stub NetBox and resolver',
+    )
+    parser.add_argument(
+        '-t',
+        '--targets',
+        nargs='+',
+        choices=TARGETS,
+        default=TARGETS,
+        help='scenarios to run, each in its own process',
+    )
+    parser.add_argument(
+        '--devices',
+        type=int,
+        default=12000,
+        help='devices served, spread over the device sites',
+    )
+    parser.add_argument(
+        '--vms',
+        type=int,
+        default=8000,
+        help='VMs served, spread over the VM sites',
+    )
+    parser.add_argument(
+        '--page_size',
+        type=int,
+        default=netbox_inventory.PAGE_SIZE,
+        help='hosts requested per page, NetBox caps it at {size}'.format(size=MAX_PAGE_SIZE),
+    )
+    parser.add_argument(
+        '--http_latency',
+        type=float,
+        default=0.05,
+        help='seconds the stub NetBox takes to answer each request',
+    )
+    parser.add_argument(
+        '--http_workers',
+        type=int,
+        default=netbox_inventory.HTTP_WORKERS,
+        help='NetBox requests in flight at once',
+    )
+    parser.add_argument(
+        '--dns_latency',
+        type=float,
+        default=0.002,
+        help='seconds the stub resolver takes for each lookup',
+    )
+    parser.add_argument(
+        '--dns_failure_rate',
+        type=float,
+        default=0.05,
+        help='share of hostnames the stub resolver resolves under no domain',
+    )
+    parser.add_argument(
+        '--dns_workers',
+        type=int,
+        default=netbox_inventory.DNS_WORKERS,
+        help='hostname lookups in flight at once',
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        type=int,
+        default=1,
+        help='runs of each scenario, the median wall time is reported',
+    )
+    parser.add_argument(
+        '-o',
+        '--results',
+        type=str,
+        default='benchmark_results.jsonl',
+        help='file the results of each run are appended to as JSON lines',
+    )
+    args = parser.parse_args()
+    if not 0 <= args.dns_failure_rate <= 1:
+        parser.error('--dns_failure_rate must be between 0 and 1')
+
+    options = {
+        'devices': args.devices,
+        'vms': args.vms,
+        'page_size': args.page_size,
+        'http_latency': args.http_latency,
+        'http_workers': args.http_workers,
+        'dns_latency': args.dns_latency,
+        'dns_failure_rate': args.dns_failure_rate,
+        'dns_workers': args.dns_workers,
+    }
+    previous = previous_results(args.results)
+    commit = git_commit()
+
+    server = StubNetBox(args.devices, args.vms, args.http_latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # a fresh interpreter for every run, so peak RSS is the run's own
+    context = multiprocessing.get_context('spawn')
+    try:
+        with open(args.results, 'a') as outfile:
+            for target in args.targets:
+                runs = list()
+                for _ in range(args.repeat):
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        runs.append(executor.submit(run_scenario, (target, server.url, options)).result())
+
+                results = dict(runs[-1])
+                results['seconds'] = round(statistics.median(run['seconds'] for run in runs), 6)
+                results['runs'] = [round(run['seconds'], 6) for run in runs]
+                results['peak_rss_kb'] = max(run['peak_rss_kb'] or 0 for run in runs) or None
+                record = {
+                    'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'commit': commit,
+                    'target': target,
+                    'options': options,
+                    'results': results,
+                }
+                outfile.write(json.dumps(record) + '\n')
+                outfile.flush()
+
+                before = previous.get((target, json.dumps(options, sort_keys=True)), {}).get('results', {})
+                print(
+                    '{target}: {seconds:.3f}s{seconds_change}, {hosts} hosts, {http_calls} requests, '
+                    '{dns_lookups} DNS lookups, peak RSS {peak_rss_kb} KB{rss_change}'.format(
+                        seconds_change=change(results['seconds'], before.get('seconds')),
+                        rss_change=change(results['peak_rss_kb'] or 0, before.get('peak_rss_kb')),
+                        **dict(results, target=target)
+                    )
+                )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
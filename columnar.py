@@ -0,0 +1,368 @@
+"""
+Compact typed columnar tables for passing exports between these scripts
+
+A table is a short header followed by row groups, each holding one binary
+buffer per column, so the next stage loads integers, addresses and VIDs
+straight into arrays instead of re-parsing CSV text. CSV remains the format
+NetBox imports.
+
+Column types:
+    str - UTF-8 text, stored as indexes into the row group's distinct values
+    int - signed 64-bit integer, an empty value is stored as INT_NULL
+    ip  - IPv4/IPv6 address or network with its prefix length, stored as
+          version, high and low 64 bits of the address and prefix length
+          with version 0 for an empty value
+
+Typed rows are dicts holding str, int (or None when empty) and ip values
+as (version, integer address, prefix length) tuples (or None when empty).
+An int or ip field whose text does not parse stays text; it is stored as
+empty with its text kept in the row group's header, and read back as text.
+"""
+
+import array
+import collections
+import csv
+import ipaddress
+import itertools
+import json
+import os
+import socket
+import sys
+
+
+MAGIC = b'NETBOX-COLUMNAR-2\n'
+
+# file extension used in place of .csv
+EXTENSION = '.col'
+
+# stored for empty int values
+INT_NULL = -2 ** 63
+
+# rows buffered before a row group is written
+GROUP_ROWS = 65536
+
+# typed arrays of an ip column
+IPColumn = collections.namedtuple(
+    'IPColumn',
+    ['versions', 'highs', 'lows', 'lengths'],
+)
+
+
+def is_columnar(path):
+    """
+    Check whether the file at path is a columnar table rather than CSV
+    """
+    with open(path, 'rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+def find_table(name):
+    """
+    Path of the export called name, as a columnar table or CSV, whichever
+    exists, or the more recently written when both do
+    """
+    paths = [
+        path for path in (name + EXTENSION, name + '.csv')
+        if os.path.exists(path)
+    ]
+    if not paths:
+        return name + '.csv'
+    return max(paths, key=os.path.getmtime)
+
+
+def parse_value(kind, text):
+    """
+    Typed value of a CSV field; ip fields that do not parse are kept as text
+    """
+    if kind == 'str':
+        return text
+    if text in ('', None):
+        return None
+    if kind == 'int':
+        try:
+            return int(text)
+        except ValueError:
+            return text
+    try:
+        interface = ipaddress.ip_interface(text.strip())
+    except ValueError:
+        return text
+    return (interface.version, int(interface.ip), interface.network.prefixlen)
+
+
+def format_ip(version, address, length):
+    """
+    Text form of an ip value, as ipaddress would write it
+    """
+    if version == 4:
+        return '{address}/{length}'.format(
+            address=socket.inet_ntoa(address.to_bytes(4, 'big')),
+            length=length,
+        )
+    return '{address}/{length}'.format(
+        address=ipaddress.IPv6Address(address),
+        length=length,
+    )
+
+
+def format_value(kind, value):
+    """
+    Text form of a typed value, as it appears in CSV
+    """
+    if value is None:
+        return ''
+    if kind == 'ip' and isinstance(value, tuple):
+        return format_ip(*value)
+    return str(value)
+
+
+def format_row(schema, row):
+    return {name: format_value(kind, row.get(name)) for name, kind in schema}
+
+
+def _new_column(kind):
+    if kind == 'str':
+        return list()
+    if kind == 'int':
+        return array.array('q')
+    if kind == 'ip':
+        return IPColumn(array.array('B'), array.array('Q'), array.array('Q'), array.array('B'))
+    raise ValueError('unknown column type {kind}'.format(kind=kind))
+
+
+def _append(column, kind, value):
+    """
+    Append a value to a column, returning its text when it is stored as
+    empty because it does not parse, else None
+    """
+    if kind == 'str':
+        column.append('' if value is None else str(value))
+        return None
+    text = None
+    if isinstance(value, str):
+        value = parse_value(kind, value)
+        if isinstance(value, str):
+            text, value = value, None
+    if kind == 'int':
+        column.append(INT_NULL if value is None else value)
+        return text
+    version, address, length = value or (0, 0, 0)
+    column.versions.append(version)
+    column.highs.append(address >> 64)
+    column.lows.append(address & 0xffffffffffffffff)
+    column.lengths.append(length)
+    return text
+
+
+def _index_typecode(count):
+    """
+    Smallest unsigned array typecode able to index count distinct values
+    """
+    for typecode in ('B', 'H', 'I', 'Q'):
+        if count <= 1 << (8 * array.array(typecode).itemsize):
+            return typecode
+
+
+def _buffers(column, kind):
+    """
+    Arrays and bytes making up a column, in file order
+    """
+    if kind == 'str':
+        distinct = dict()
+        indexes = array.array('Q', (distinct.setdefault(value, len(distinct)) for value in column))
+        indexes = array.array(_index_typecode(len(distinct)), indexes)
+        encoded = [value.encode() for value in distinct]
+        offsets = array.array('Q', [0])
+        offsets.extend(itertools.accumulate(len(value) for value in encoded))
+        return [indexes, offsets, b''.join(encoded)]
+    if kind == 'int':
+        return [column]
+    return list(column)
+
+
+def _write_group(outfile, schema, columns, count, texts):
+    buffers = list()
+    indexes = list()
+    for column, (_, kind) in zip(columns, schema):
+        column_buffers = _buffers(column, kind)
+        if kind == 'str':
+            indexes.append(column_buffers[0].typecode)
+        buffers.extend(column_buffers)
+    header = {
+        'rows': count,
+        'buffers': [memoryview(buffer).nbytes for buffer in buffers],
+        'indexes': indexes,
+    }
+    if texts:
+        # text of the values stored empty, by column and row
+        header['texts'] = texts
+    outfile.write(json.dumps(header).encode() + b'\n')
+    for buffer in buffers:
+        outfile.write(buffer)
+
+
+def write_table(path, schema, rows):
+    """
+    Write rows, given as typed or text dicts, to a columnar table
+    schema is a list of (name, type) pairs; columns missing from a row are
+    written empty. Rows are written in groups of GROUP_ROWS, so memory
+    does not grow with the table.
+    """
+    header = {
+        'byteorder': sys.byteorder,
+        'columns': [list(field) for field in schema],
+    }
+    rows = iter(rows)
+    with open(path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(json.dumps(header).encode() + b'\n')
+        while True:
+            columns = [_new_column(kind) for _, kind in schema]
+            texts = dict()
+            count = 0
+            for row in itertools.islice(rows, GROUP_ROWS):
+                for column, (name, kind) in zip(columns, schema):
+                    text = _append(column, kind, row.get(name))
+                    if text is not None:
+                        texts.setdefault(name, dict())[count] = text
+                count += 1
+            if not count:
+                break
+            _write_group(outfile, schema, columns, count, texts)
+
+
+def _load(typecode, data, swap):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if swap:
+        values.byteswap()
+    return values
+
+
+def iter_groups(path):
+    """
+    Yield the schema, then the columns of each row group of a table as a
+    dict by name: a list of str, an array of int, or an IPColumn of arrays,
+    along with the text of values stored empty as a dict by name of dicts
+    by row
+    """
+    with open(path, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{path} is not a columnar table'.format(path=path))
+        header = json.loads(infile.readline())
+        swap = header['byteorder'] != sys.byteorder
+        schema = [tuple(field) for field in header['columns']]
+        yield schema
+
+        while True:
+            line = infile.readline()
+            if not line:
+                return
+            group = json.loads(line)
+            buffers = iter([infile.read(length) for length in group['buffers']])
+            indexes = iter(group['indexes'])
+            columns = dict()
+            for name, kind in schema:
+                if kind == 'str':
+                    positions = _load(next(indexes), next(buffers), swap)
+                    offsets = _load('Q', next(buffers), swap)
+                    data = next(buffers)
+                    distinct = [
+                        data[offsets[i]:offsets[i + 1]].decode()
+                        for i in range(len(offsets) - 1)
+                    ]
+                    columns[name] = [distinct[i] for i in positions]
+                elif kind == 'int':
+                    columns[name] = _load('q', next(buffers), swap)
+                else:
+                    columns[name] = IPColumn(*(
+                        _load(typecode, next(buffers), swap)
+                        for typecode in ('B', 'Q', 'Q', 'B')
+                    ))
+            texts = {
+                name: {int(row): text for row, text in column_texts.items()}
+                for name, column_texts in group.get('texts', {}).items()
+            }
+            yield columns, texts
+
+
+def _typed_column(column, kind, texts=None):
+    if kind == 'str':
+        return column
+    if kind == 'int':
+        values = [None if value == INT_NULL else value for value in column]
+    else:
+        values = [
+            (version, high << 64 | low, length) if version else None
+            for version, high, low, length in zip(*column)
+        ]
+    for row, text in (texts or {}).items():
+        values[row] = text
+    return values
+
+
+def iter_typed(path, schema=None):
+    """
+    Yield the rows of an export as typed dicts, loading a columnar table
+    without any text parsing, or parsing a CSV according to schema
+    """
+    if is_columnar(path):
+        groups = iter_groups(path)
+        table_schema = next(groups)
+        names = [name for name, _ in table_schema]
+        for columns, texts in groups:
+            values = [_typed_column(columns[name], kind, texts.get(name)) for name, kind in table_schema]
+            for row in zip(*values):
+                yield dict(zip(names, row))
+        return
+
+    kinds = dict(schema or ())
+    with open(path, newline='') as csvfile:
+        for row in csv.DictReader(csvfile, dialect='unix', delimiter=',', quotechar='"'):
+            yield {
+                name: parse_value(kinds.get(name, 'str'), value)
+                for name, value in row.items()
+            }
+
+
+def table_columns(path):
+    """
+    Names of the columns of an export, from its header
+    """
+    if is_columnar(path):
+        groups = iter_groups(path)
+        try:
+            return [name for name, _ in next(groups)]
+        finally:
+            groups.close()
+    with open(path, newline='') as csvfile:
+        return next(csv.reader(csvfile, dialect='unix', delimiter=',', quotechar='"'), [])
+
+
+def iter_rows(path):
+    """
+    Yield the rows of an export as read: typed dicts from a columnar table,
+    or text dicts from a CSV without parsing any field
+    """
+    if is_columnar(path):
+        yield from iter_typed(path)
+        return
+    with open(path, newline='') as csvfile:
+        yield from csv.DictReader(csvfile, dialect='unix', delimiter=',', quotechar='"')
+
+
+def write_rows(path, schema, rows, output_format):
+    """
+    Write typed rows to path as CSV, or as a columnar table
+    """
+    if output_format == 'columnar':
+        write_table(path, schema, rows)
+        return
+    with open(path, 'w', newline='') as csvfile:
+        fieldnames = [name for name, _ in schema]
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect='unix')
+        writer.writeheader()
+        writer.writerows(format_row(schema, row) for row in rows)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -1,100 +1,509 @@
 #!/usr/bin/env python3
 
-import csv
+import argparse
+import array
+import concurrent.futures
+import os
 import sys
 
+import columnar
+import metrics
 
-def unique_vlans():
-    netbox_list = set()
-    with open('ipplan_vlans.csv', newline='') as ipplan_csv, open('netbox_vlans.csv', newline='') as netbox_csv, open('unique_vlans.csv', 'w', newline='') as outfile:
-        # setup header for csv file
-        fieldnames = [
-            'site',
-            'group_name',
-            'vid',
-            'name',
-            'tenant',
-            'status',
-            'role',
-            'description',
-        ]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames, dialect='unix')
-        writer.writeheader()
-
-        netbox = csv.DictReader(netbox_csv, dialect='unix', delimiter=',', quotechar='"')
-        for vlan in netbox:
-            net = '{group_name}-v{vid}'.format(group_name=vlan['group_name'], vid=vlan['vid']).lower()
-            netbox_list.add(net)
-
-        ipplan = csv.DictReader(ipplan_csv, dialect='unix', delimiter=',', quotechar='"')
-        for vlan in ipplan:
-            ip = '{group_name}-v{vid}'.format(group_name=vlan['group_name'], vid=vlan['vid']).lower()
-            if ip not in netbox_list:
-                writer.writerow(vlan)
-
-
-def unique_prefixes():
-    netbox_list = set()
-    with open('ipplan_prefixes.csv', newline='') as ipplan_csv, open('netbox_prefixes.csv', newline='') as netbox_csv, open('unique_prefixes.csv', 'w', newline='') as outfile:
-        # setup header for csv file
-        fieldnames = [
-            'prefix',
-            'vrf',
-            'tenant',
-            'site',
-            'vlan_group',
-            'vlan_vid',
-            'status',
-            'role',
-            'is_pool',
-            'description',
-        ]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames, dialect='unix')
-        writer.writeheader()
-
-        netbox = csv.DictReader(netbox_csv, dialect='unix', delimiter=',', quotechar='"')
-        for prefix in netbox:
-            netbox_list.add(prefix['prefix'])
-
-        ipplan = csv.DictReader(ipplan_csv, dialect='unix', delimiter=',', quotechar='"')
-        for prefix in ipplan:
-            if prefix['prefix'] not in netbox_list:
-                writer.writerow(prefix)
-
-
-def unique_addresses():
-    netbox_list = set()
-    with open('ipplan_addresses.csv', newline='') as ipplan_csv, open('netbox_addresses.csv', newline='') as netbox_csv, open('unique_addresses.csv', 'w', newline='') as outfile:
-        # setup header for csv file
-        fieldnames = [
-            'address',
-            'vrf',
-            'tenant',
-            'status',
-            'role',
-            'device',
-            'virtual_machine',
-            'interface_name',
-            'is_primary',
-            'description',
-        ]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames, dialect='unix')
-        writer.writeheader()
-
-        netbox = csv.DictReader(netbox_csv, dialect='unix', delimiter=',', quotechar='"')
-        for address in netbox:
-            netbox_list.add(address['address'])
-
-        ipplan = csv.DictReader(ipplan_csv, dialect='unix', delimiter=',', quotechar='"')
-        for address in ipplan:
-            if address['address'] not in netbox_list:
-                writer.writerow(address)
+
+# output columns and their types when written as columnar tables
+VLAN_SCHEMA = [
+    ('site', 'str'),
+    ('group_name', 'str'),
+    ('vid', 'int'),
+    ('name', 'str'),
+    ('tenant', 'str'),
+    ('status', 'str'),
+    ('role', 'str'),
+    ('description', 'str'),
+]
+PREFIX_SCHEMA = [
+    ('prefix', 'ip'),
+    ('vrf', 'str'),
+    ('tenant', 'str'),
+    ('site', 'str'),
+    ('vlan_group', 'str'),
+    ('vlan_vid', 'int'),
+    ('status', 'str'),
+    ('role', 'str'),
+    ('is_pool', 'str'),
+    ('description', 'str'),
+]
+ADDRESS_SCHEMA = [
+    ('address', 'ip'),
+    ('vrf', 'str'),
+    ('tenant', 'str'),
+    ('status', 'str'),
+    ('role', 'str'),
+    ('device', 'str'),
+    ('virtual_machine', 'str'),
+    ('interface_name', 'str'),
+    ('is_primary', 'str'),
+    ('description', 'str'),
+]
+
+DIFF_SCHEMA = [
+    ('change', 'str'),
+    ('key', 'str'),
+    ('field', 'str'),
+    ('ipplan', 'str'),
+    ('netbox', 'str'),
+]
+OVERLAP_SCHEMA = [
+    ('prefix', 'ip'),
+    ('ipplan_prefix', 'str'),
+    ('vrf', 'str'),
+    ('description', 'str'),
+    ('match', 'str'),
+    ('netbox_prefix', 'ip'),
+]
+
+
+def extension(output_format):
+    return columnar.EXTENSION if output_format == 'columnar' else '.csv'
+
+
+# keys compare the text of the key columns, as written in a CSV export or
+# formatted from a columnar one, so CSV fields are never parsed
+def vlan_key(vlan):
+    return (vlan['group_name'].lower(), columnar.format_value('int', vlan['vid']))
+
+
+def prefix_key(prefix):
+    return columnar.format_value('ip', prefix['prefix'])
+
+
+def address_key(address):
+    return columnar.format_value('ip', address['address'])
+
+
+def typed(kind, value):
+    """
+    Typed form of a value read from either format
+    """
+    return columnar.parse_value(kind, value) if isinstance(value, str) else value
+
+
+# orders give the typed key, parsing only the key columns of a CSV, so
+# exports sorted numerically are merged in that order
+def vlan_order(vlan):
+    return (vlan['group_name'].lower(), typed('int', vlan['vid']))
+
+
+def prefix_order(prefix):
+    return typed('ip', prefix['prefix'])
+
+
+def address_order(address):
+    return typed('ip', address['address'])
+
+
+# key function, order function and schema of each object type, by the name
+# its exports share, e.g. ipplan_vlans and netbox_vlans
+TABLES = {
+    'vlans': (vlan_key, vlan_order, VLAN_SCHEMA),
+    'prefixes': (prefix_key, prefix_order, PREFIX_SCHEMA),
+    'addresses': (address_key, address_order, ADDRESS_SCHEMA),
+}
+
+# columns making up the key of each object type, left out of field diffs
+KEY_FIELDS = {
+    'vlans': ['group_name', 'vid'],
+    'prefixes': ['prefix'],
+    'addresses': ['address'],
+}
+
+
+def hash_join(ipplan, netbox, key, build_ipplan):
+    """
+    Yield the IPPlan rows whose key is not among the NetBox rows
+    The side chosen by build_ipplan is held in memory and the other is
+    streamed past it; IPPlan rows are yielded in their input order either way
+    """
+    if not build_ipplan:
+        netbox_keys = {key(row) for row in netbox}
+        for row in ipplan:
+            if key(row) not in netbox_keys:
+                yield row
+        return
+
+    rows = list(ipplan)
+    ipplan_keys = {key(row) for row in rows}
+    # only keys also in IPPlan are kept, so this stays within its size
+    matched = set()
+    for row in netbox:
+        row_key = key(row)
+        if row_key in ipplan_keys:
+            matched.add(row_key)
+    del ipplan_keys
+    for row in rows:
+        if key(row) not in matched:
+            yield row
+
+
+class NotSorted(Exception):
+    """
+    An export given to merge_join is not in key order
+    """
+
+
+def sort_key(value):
+    """
+    Totally ordered form of a key, so empty and unparsed values compare
+    with the others: empty first, then numbers, then text
+    """
+    if value is None:
+        return (0,)
+    if isinstance(value, tuple):
+        return (1, tuple(sort_key(item) for item in value))
+    if isinstance(value, int):
+        return (2, value)
+    return (3, value)
+
+
+def sorted_keys(rows, order, path):
+    """
+    Yield (sort key, row) for each row, raising NotSorted as soon as a key
+    is lower than the one before it
+    """
+    previous = None
+    for row in rows:
+        current = sort_key(order(row))
+        if previous is not None and current < previous:
+            raise NotSorted(path)
+        previous = current
+        yield current, row
+
+
+def merge_join(ipplan, netbox, order, paths):
+    """
+    Yield the IPPlan rows whose key is not among the NetBox rows, walking
+    both exports in lockstep, which must be sorted by the typed key order
+    gives
+    Only the current row of each is held, so memory does not grow with the
+    exports
+    """
+    netbox = sorted_keys(netbox, order, paths[1])
+    netbox_key = next(netbox, (None,))[0]
+    for ipplan_key, row in sorted_keys(ipplan, order, paths[0]):
+        while netbox_key is not None and netbox_key < ipplan_key:
+            netbox_key = next(netbox, (None,))[0]
+        if netbox_key != ipplan_key:
+            yield row
+
+
+def unique_rows(name, output_format='csv', join='hash'):
+    """
+    Write the IPPlan rows of one object type that are missing from NetBox,
+    by merging sorted exports or hashing whichever of the two is smaller
+    """
+    with metrics.phase(name):
+        key, order, schema = TABLES[name]
+        ipplan_path = columnar.find_table('ipplan_' + name)
+        netbox_path = columnar.find_table('netbox_' + name)
+        output_path = 'unique_' + name + extension(output_format)
+
+        if join == 'merge':
+            unique = merge_join(
+                metrics.counted(name, columnar.iter_rows(ipplan_path)),
+                columnar.iter_rows(netbox_path),
+                order,
+                (ipplan_path, netbox_path),
+            )
+            try:
+                columnar.write_rows(output_path, schema, unique, output_format)
+                return
+            except NotSorted as e:
+                # the output is written again from the start
+                sys.stderr.write('{path} is not sorted by key, comparing {name} by hash\n'.format(path=e, name=name))
+
+        build_ipplan = os.path.getsize(ipplan_path) < os.path.getsize(netbox_path)
+        unique = hash_join(
+            metrics.counted(name, columnar.iter_rows(ipplan_path)),
+            columnar.iter_rows(netbox_path),
+            key,
+            build_ipplan,
+        )
+        columnar.write_rows(output_path, schema, unique, output_format)
+
+
+def field_hashes(row, fields, kinds):
+    """
+    Hashes of the text of the fields of a row packed into bytes, 8 per
+    field, so identical rows are confirmed by one comparison and the fields
+    that differ are found by comparing slices; empty and missing fields
+    match
+    """
+    hashes = array.array('q', (hash(columnar.format_value(kinds[name], row.get(name))) for name in fields))
+    return hashes.tobytes()
+
+
+def differing_fields(first, second, fields):
+    """
+    Names of the fields whose hashes differ between two field_hashes
+    """
+    return [
+        name for i, name in enumerate(fields)
+        if first[i * 8:i * 8 + 8] != second[i * 8:i * 8 + 8]
+    ]
+
+
+def diff_rows(name, output_format='csv'):
+    """
+    Write the records of one object type added to IPPlan (missing from
+    NetBox), removed from it (only in NetBox) or changed, one row per
+    differing field with both values
+    Only the key and field hashes of the smaller export are held; it is
+    read a second time for the values of its added and changed records
+    """
+    with metrics.phase('diff ' + name):
+        key, _, schema = TABLES[name]
+        kinds = dict(schema)
+        key_fields = KEY_FIELDS[name]
+        ipplan_path = columnar.find_table('ipplan_' + name)
+        netbox_path = columnar.find_table('netbox_' + name)
+        # a column only one export has, like the device of a NetBox address,
+        # would differ on every record
+        shared = set(columnar.table_columns(ipplan_path)) & set(columnar.table_columns(netbox_path))
+        fields = [field for field, _ in schema if field in shared and field not in key_fields]
+        build_ipplan = os.path.getsize(ipplan_path) < os.path.getsize(netbox_path)
+        build_path, probe_path = (ipplan_path, netbox_path) if build_ipplan else (netbox_path, ipplan_path)
+        # what a record only on either side is called
+        build_only, probe_only = ('added', 'removed') if build_ipplan else ('removed', 'added')
+
+        def key_text(row):
+            return ' '.join(columnar.format_value(kinds[field], row.get(field)) for field in key_fields)
+
+        def value_text(row, field):
+            return columnar.format_value(kinds[field], row.get(field))
+
+        def diffs():
+            built = dict()
+            for row in columnar.iter_rows(build_path):
+                built.setdefault(key(row), field_hashes(row, fields, kinds))
+
+            # probe rows whose fields differ, by key, with those fields
+            changed = dict()
+            seen = set()
+            for row in metrics.counted('diff ' + name, columnar.iter_rows(probe_path)):
+                row_key = key(row)
+                hashes = built.get(row_key)
+                if hashes is None:
+                    yield {'change': probe_only, 'key': key_text(row)}
+                    continue
+                seen.add(row_key)
+                probe_hashes = field_hashes(row, fields, kinds)
+                if probe_hashes != hashes and row_key not in changed:
+                    changed[row_key] = {
+                        field: value_text(row, field)
+                        for field in differing_fields(hashes, probe_hashes, fields)
+                    }
+            del built
+
+            # read the smaller export again for the rows only it has and the
+            # other side of changed rows
+            for row in columnar.iter_rows(build_path):
+                row_key = key(row)
+                if row_key not in seen:
+                    yield {'change': build_only, 'key': key_text(row)}
+                    # later rows with the same key are duplicates
+                    seen.add(row_key)
+                    continue
+                values = changed.pop(row_key, None)
+                if values is None:
+                    continue
+                for field, probe_value in values.items():
+                    build_value = value_text(row, field)
+                    yield {
+                        'change': 'changed',
+                        'key': key_text(row),
+                        'field': field,
+                        'ipplan': build_value if build_ipplan else probe_value,
+                        'netbox': probe_value if build_ipplan else build_value,
+                    }
+
+        columnar.write_rows('diff_' + name + extension(output_format), DIFF_SCHEMA, diffs(), output_format)
+
+
+def network_key(value):
+    """
+    (version, network address, prefix length) of a typed or text prefix,
+    with any host bits cleared; dotted quads, including ones with zero
+    padded octets that ipaddress rejects, are read without ipaddress
+    Returns None when the value is not a prefix
+    """
+    if isinstance(value, str) and ':' in value:
+        value = columnar.parse_value('ip', value)
+        if isinstance(value, str):
+            return None
+    elif isinstance(value, str):
+        address, _, length = value.strip().partition('/')
+        octets = address.split('.')
+        try:
+            if len(octets) != 4 or not all(0 <= int(octet) <= 255 for octet in octets):
+                return None
+            length = int(length) if length else 32
+        except ValueError:
+            return None
+        if not 0 <= length <= 32:
+            return None
+        value = (4, int.from_bytes(bytes(int(octet) for octet in octets), 'big'), length)
+    if value is None:
+        return None
+    version, address, length = value
+    width = 32 if version == 4 else 128
+    host_bits = width - length
+    return (version, address >> host_bits << host_bits, length)
+
+
+class PrefixTrie:
+    """
+    Binary trie of prefixes per VRF and IP version, branching on network
+    address bits, so the prefixes covering or lying within a given one are
+    found by walking no more nodes than its prefix length
+    Each node is a list of its 0 and 1 children and the values stored at it
+    """
+
+    def __init__(self):
+        self.roots = dict()
+
+    def add(self, vrf, network, value):
+        version, address, length = network
+        width = 32 if version == 4 else 128
+        node = self.roots.setdefault((vrf, version), [None, None, []])
+        for depth in range(length):
+            bit = address >> (width - 1 - depth) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(value)
+
+    def matches(self, vrf, network):
+        """
+        Yield (match, value) for each stored prefix related to network:
+        'contained' when it lies within a stored prefix, 'exact' when they
+        are equal and 'containing' when a stored prefix lies within it
+        CIDR prefixes only overlap by one containing the other, so these
+        cover every overlap
+        """
+        version, address, length = network
+        width = 32 if version == 4 else 128
+        node = self.roots.get((vrf, version))
+        for depth in range(length):
+            if node is None:
+                return
+            for value in node[2]:
+                yield 'contained', value
+            node = node[address >> (width - 1 - depth) & 1]
+        if node is None:
+            return
+        for value in node[2]:
+            yield 'exact', value
+
+        stack = [child for child in node[:2] if child is not None]
+        while stack:
+            node = stack.pop()
+            for value in node[2]:
+                yield 'containing', value
+            stack.extend(child for child in node[:2] if child is not None)
+
+
+def prefix_overlaps(output_format='csv'):
+    """
+    Write every pair of an IPPlan prefix and a NetBox prefix in the same
+    VRF that are equal or where one contains the other
+    """
+    trie = PrefixTrie()
+    with metrics.phase('overlap index'):
+        for prefix in columnar.iter_rows(columnar.find_table('netbox_prefixes')):
+            network = network_key(prefix['prefix'])
+            if network is not None:
+                trie.add(prefix['vrf'], network, network)
+
+    def overlaps():
+        ipplan = columnar.iter_rows(columnar.find_table('ipplan_prefixes'))
+        for prefix in metrics.counted('overlaps', ipplan):
+            network = network_key(prefix['prefix'])
+            if network is None:
+                continue
+            for match, netbox_prefix in trie.matches(prefix['vrf'], network):
+                yield {
+                    'prefix': network,
+                    # as IPPlan wrote it, so formatting differences show
+                    'ipplan_prefix': columnar.format_value('ip', prefix['prefix']),
+                    'vrf': prefix['vrf'],
+                    'description': prefix.get('description'),
+                    'match': match,
+                    'netbox_prefix': netbox_prefix,
+                }
+
+    with metrics.phase('overlaps'):
+        columnar.write_rows('prefix_overlaps' + extension(output_format), OVERLAP_SCHEMA, overlaps(), output_format)
+
+
+def measured(progress, function, *args):
+    """
+    Run one comparison in a worker process, returning the metrics it
+    recorded for the parent to merge
+    """
+    current = metrics.reset()
+    current.progress = progress
+    function(*args)
+    return current.state()
 
 
 def main():
-    unique_vlans()
-    unique_prefixes()
-    unique_addresses()
+    parser = argparse.ArgumentParser(
+        description='Compare IPPlan exports with Netbox exports',
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=['csv', 'columnar'],
+        default='csv',
+        help='format of the unique rows written; exports are read as CSV or columnar, whichever exists',
+    )
+    parser.add_argument(
+        '-j',
+        '--join',
+        choices=['hash', 'merge'],
+        default='hash',
+        help='merge exports already sorted by key in constant memory, falling back to hash for any that are not',
+    )
+    parser.add_argument(
+        '-o',
+        '--overlaps',
+        action='store_true',
+        help='also write IPPlan prefixes equal to, within or containing NetBox prefixes of the same VRF to prefix_overlaps',
+    )
+    parser.add_argument(
+        '-d',
+        '--diff',
+        action='store_true',
+        help='also write the records added, removed or changed, field by field, to diff_vlans, diff_prefixes and diff_addresses',
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics.session(args):
+        # the comparisons are independent and CPU bound, so they run side by
+        # side in worker processes
+        tasks = [(unique_rows, name, args.format, args.join) for name in TABLES]
+        if args.diff:
+            tasks.extend((diff_rows, name, args.format) for name in TABLES)
+        if args.overlaps:
+            tasks.append((prefix_overlaps, args.format))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(measured, args.progress, *task) for task in tasks]
+            for future in futures:
+                try:
+                    metrics.current.merge(future.result())
+                except OSError as e:
+                    sys.exit('Error comparing exports: {error}'.format(error=e))
 
 
 if __name__ == '__main__':
@@ -1,44 +1,351 @@
 #!/usr/bin/env python3
 
+import argparse
 import csv
+import hashlib
+import heapq
+import io
 import ipaddress
+import locale
+import math
+import multiprocessing
+import os
+import pickle
+import socket
 import sys
+import tempfile
+import zlib
 
+import metrics
 
-def unique_addresses():
-    netbox_list = set()
+
+# bytes in a packed key: version, address widened to 16 bytes, prefix length
+KEY_SIZE = 18
+
+# keys sorted at a time while building the key set
+SORT_CHUNK = 65536
+
+# columns of the unique addresses written
+FIELDNAMES = [
+    'address',
+    'vrf',
+    'tenant',
+    'status',
+    'role',
+    'device',
+    'virtual_machine',
+    'interface_name',
+    'is_primary',
+    'description',
+]
+
+
+def pack_address(text):
+    """
+    Normalized fixed-width key of an address with optional prefix length,
+    so differently written forms of the same interface pack the same
+    """
+    address, _, length = text.strip().partition('/')
+    try:
+        if ':' in address:
+            version, maxlen = 6, 128
+            packed = socket.inet_pton(socket.AF_INET6, address)
+        else:
+            version, maxlen = 4, 32
+            packed = bytes(12) + socket.inet_pton(socket.AF_INET, address)
+        length = int(length) if length else maxlen
+        if not 0 <= length <= maxlen:
+            raise ValueError(length)
+    except (OSError, ValueError):
+        # netmask and other forms only ipaddress understands
+        interface = ipaddress.ip_interface(text.strip())
+        version = interface.version
+        packed = interface.ip.packed.rjust(16, b'\0')
+        length = interface.network.prefixlen
+    return bytes([version]) + packed + bytes([length])
+
+
+class PackedKeys:
+    """
+    Sorted, distinct address keys packed end to end in a single buffer and
+    looked up by bisection, KEY_SIZE bytes per address
+    """
+
+    def __init__(self, keys):
+        # sort chunks of keys, then merge them into the buffer
+        runs = list()
+        chunk = list()
+        for key in keys:
+            chunk.append(key)
+            if len(chunk) == SORT_CHUNK:
+                runs.append(b''.join(sorted(chunk)))
+                chunk = list()
+        runs.append(b''.join(sorted(chunk)))
+        del chunk
+
+        self.data = bytearray()
+        previous = None
+        for key in heapq.merge(*(self.iter_run(run) for run in runs)):
+            if key != previous:
+                self.data += key
+                previous = key
+
+    @staticmethod
+    def iter_run(run):
+        for offset in range(0, len(run), KEY_SIZE):
+            yield run[offset:offset + KEY_SIZE]
+
+    def __len__(self):
+        return len(self.data) // KEY_SIZE
+
+    def __getitem__(self, index):
+        offset = index * KEY_SIZE
+        return self.data[offset:offset + KEY_SIZE]
+
+    def __iter__(self):
+        return self.iter_run(self.data)
+
+    def __contains__(self, key):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low < len(self) and self[low] == key
+
+
+class BloomFilter:
+    """
+    Bit array answering whether a key may be in a set, with no false
+    negatives and false positives at about the given rate
+    """
+
+    def __init__(self, count, rate):
+        count = max(count, 1)
+        self.size = max(8, int(-count * math.log(rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / count * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little')
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & 1 << (position & 7) for position in self.positions(key))
+
+
+def unique_addresses(bloom_rate=None):
     with open('ipplan_addresses.csv', newline='') as ipplan_csv, open('netbox_ipam_ipaddress.csv', newline='') as netbox_csv, open('unique_addresses.csv', 'w', newline='') as outfile:
         # setup header for csv file
-        fieldnames = [
-            'address',
-            'vrf',
-            'tenant',
-            'status',
-            'role',
-            'device',
-            'virtual_machine',
-            'interface_name',
-            'is_primary',
-            'description',
-        ]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames, dialect='unix')
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES, dialect='unix')
         writer.writeheader()
 
-        netbox = csv.DictReader(netbox_csv)
-        for address in netbox:
-            ip = ipaddress.ip_interface(address['address'])
-            netbox_list.add(str(ip))
+        netbox = metrics.counted('netbox', csv.DictReader(netbox_csv))
+        with metrics.phase('netbox'):
+            netbox_keys = PackedKeys(pack_address(address['address']) for address in netbox)
+
+            # most IPPlan addresses missing from NetBox are ruled out by the
+            # filter without searching the keys
+            prefilter = None
+            if bloom_rate:
+                prefilter = BloomFilter(len(netbox_keys), bloom_rate)
+                for key in netbox_keys:
+                    prefilter.add(key)
 
-        ipplan = csv.DictReader(ipplan_csv)
-        for address in ipplan:
-            ip = ipaddress.ip_interface(address['address'])
-            print('Processing {ip}'.format(ip=ip))
-            if str(ip) not in netbox_list:
-                writer.writerow(address)
+        ipplan = metrics.counted('compare', csv.DictReader(ipplan_csv))
+        with metrics.phase('compare'):
+            for address in ipplan:
+                key = pack_address(address['address'])
+                if prefilter is not None and key not in prefilter:
+                    writer.writerow(address)
+                elif key not in netbox_keys:
+                    writer.writerow(address)
+
+
+def partition(key, partitions):
+    """
+    Partition of a packed key, the same in every process
+    """
+    return zlib.crc32(key) % partitions
+
+
+def iter_line_chunks(path, chunk_size):
+    """
+    Yield (start, end) byte ranges of roughly chunk_size bytes covering
+    whole lines of a CSV after its header
+    Fields are assumed not to contain line breaks
+    """
+    with open(path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        infile.readline()
+        start = infile.tell()
+        while start < size:
+            infile.seek(min(start + chunk_size, size))
+            infile.readline()
+            end = min(infile.tell(), size)
+            yield start, end
+            start = end
+
+
+def read_header(path):
+    with open(path, newline='') as csvfile:
+        return next(csv.reader(csvfile), [])
+
+
+def read_chunk(path, fieldnames, start, end):
+    """
+    Rows of one byte range of a CSV as dicts
+    """
+    with open(path, 'rb') as infile:
+        infile.seek(start)
+        text = infile.read(end - start).decode(locale.getpreferredencoding(False))
+    return csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames)
+
+
+def partition_chunk(task):
+    """
+    Sort the rows of one chunk of an export into partition files in a
+    worker process: the packed keys of NetBox addresses, or the index,
+    key and CSV line of IPPlan addresses
+    Returns the paths of the partition files, by partition
+    """
+    side, path, fieldnames, number, start, end, partitions, directory = task
+    parts = [list() for _ in range(partitions)]
+    if side == 'netbox':
+        for row in read_chunk(path, fieldnames, start, end):
+            key = pack_address(row['address'])
+            parts[partition(key, partitions)].append(key)
+        parts = [b''.join(keys) for keys in parts]
+    else:
+        line = io.StringIO()
+        writer = csv.DictWriter(line, fieldnames=FIELDNAMES, dialect='unix')
+        for index, row in enumerate(read_chunk(path, fieldnames, start, end)):
+            key = pack_address(row['address'])
+            writer.writerow(row)
+            parts[partition(key, partitions)].append((index, key, line.getvalue()))
+            line.seek(0)
+            line.truncate()
+
+    paths = list()
+    for part_number, part in enumerate(parts):
+        part_path = os.path.join(directory, '{side}-{chunk}-{part}'.format(side=side, chunk=number, part=part_number))
+        with open(part_path, 'wb') as outfile:
+            pickle.dump(part, outfile, pickle.HIGHEST_PROTOCOL)
+        paths.append(part_path)
+    return paths
+
+
+def compare_partition(task):
+    """
+    Find the IPPlan addresses of one partition missing from NetBox in a
+    worker process
+    Returns (chunk, index, CSV line) of each
+    """
+    netbox_paths, ipplan_paths, bloom_rate = task
+
+    def netbox_keys():
+        for path in netbox_paths:
+            with open(path, 'rb') as infile:
+                yield from PackedKeys.iter_run(pickle.load(infile))
+
+    keys = PackedKeys(netbox_keys())
+    prefilter = None
+    if bloom_rate:
+        prefilter = BloomFilter(len(keys), bloom_rate)
+        for key in keys:
+            prefilter.add(key)
+
+    unique = list()
+    for chunk, path in enumerate(ipplan_paths):
+        with open(path, 'rb') as infile:
+            rows = pickle.load(infile)
+        for index, key, line in rows:
+            if (prefilter is not None and key not in prefilter) or key not in keys:
+                unique.append((chunk, index, line))
+    return unique
+
+
+def unique_addresses_parallel(workers, chunk_size, bloom_rate=None):
+    """
+    Hash-partition both exports by packed key across a pool of worker
+    processes, compare each partition in the pool and write the unique
+    IPPlan addresses in their input order
+    """
+    partitions = workers
+    with tempfile.TemporaryDirectory() as directory, multiprocessing.Pool(workers) as pool:
+        parts = dict()
+        with metrics.phase('partition'):
+            for side, path in (('netbox', 'netbox_ipam_ipaddress.csv'), ('ipplan', 'ipplan_addresses.csv')):
+                fieldnames = read_header(path)
+                tasks = [
+                    (side, path, fieldnames, number, start, end, partitions, directory)
+                    for number, (start, end) in enumerate(iter_line_chunks(path, chunk_size))
+                ]
+                # partition files by partition, each in chunk order
+                parts[side] = list(zip(*pool.map(partition_chunk, tasks))) or [()] * partitions
+
+        with metrics.phase('compare'):
+            tasks = [
+                (parts['netbox'][number], parts['ipplan'][number], bloom_rate)
+                for number in range(partitions)
+            ]
+            unique = list()
+            for rows in pool.imap_unordered(compare_partition, tasks):
+                unique.extend(rows)
+            unique.sort()
+
+    with open('unique_addresses.csv', 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES, dialect='unix')
+        writer.writeheader()
+        outfile.writelines(line for _, _, line in unique)
 
 
 def main():
-    unique_addresses()
+    parser = argparse.ArgumentParser(
+        description='Compare IPPlan and Netbox addresses for duplicates',
+    )
+    parser.add_argument(
+        '-b',
+        '--bloom',
+        type=float,
+        metavar='RATE',
+        help='prefilter lookups with a Bloom filter of this false positive rate, e.g. 0.01',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='processes comparing hash partitions of the addresses, 1 compares while streaming',
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=4 * 1024 * 1024,
+        help='approximate bytes of CSV handed to a worker at a time when partitioning',
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.bloom is not None and not 0 < args.bloom < 1:
+        parser.error('--bloom must be between 0 and 1')
+
+    with metrics.session(args):
+        try:
+            if args.workers > 1:
+                unique_addresses_parallel(args.workers, args.chunk_size, args.bloom)
+            else:
+                unique_addresses(args.bloom)
+        except ValueError as e:
+            sys.exit('Error: {error}'.format(error=e))
 
 
 if __name__ == '__main__':
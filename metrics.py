@@ -0,0 +1,287 @@
+"""
+Shared instrumentation for these scripts
+
+Each script records the wall time and row counts of its phases, and the
+count and latency of its HTTP, DNS and SSH calls, through the module level
+phase, count, counted and call functions. Options added by add_arguments emit them as a JSON report or as
+a rate-limited progress line on stderr, and optionally run the script
+under cProfile or tracemalloc.
+"""
+
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak RSS is not reported
+    resource = None
+
+
+# allocation sites listed in the report when tracing memory
+TRACE_TOP = 10
+
+
+class Metrics:
+    """
+    Phase timings, row counts and call latencies of one run
+    Safe to update from several threads at once
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.seconds = collections.OrderedDict()
+        # when each phase was first entered, for the rate in progress lines
+        self.entered = dict()
+        self.rows = collections.Counter()
+        self.calls = collections.OrderedDict()
+        # seconds between progress lines, None when they are off
+        self.progress = None
+        self.last_progress = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Add the wall time spent in the block to the phase called name
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.entered.setdefault(name, start)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+    def count(self, name, rows=1):
+        """
+        Add rows processed by the phase called name
+        """
+        with self.lock:
+            self.rows[name] += rows
+            if self.progress is None:
+                return
+            now = time.perf_counter()
+            if now - self.last_progress < self.progress:
+                return
+            self.last_progress = now
+            total = self.rows[name]
+            elapsed = now - self.entered.get(name, self.started)
+        sys.stderr.write(
+            '{name}: {rows:,} rows, {rate:,.0f} rows/s\n'.format(
+                name=name,
+                rows=total,
+                rate=total / elapsed if elapsed else 0,
+            )
+        )
+
+    def counted(self, name, rows, batch=1024):
+        """
+        Yield rows, counting them towards the phase called name in batches
+        """
+        count = 0
+        for row in rows:
+            yield row
+            count += 1
+            if count == batch:
+                self.count(name, count)
+                count = 0
+        if count:
+            self.count(name, count)
+
+    @contextlib.contextmanager
+    def call(self, kind):
+        """
+        Count the block as one call of kind, e.g. http, dns or ssh, along
+        with its latency and whether it raised
+        """
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                calls = self.calls.setdefault(kind, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0})
+                calls['count'] += 1
+                calls['errors'] += failed
+                calls['seconds'] += elapsed
+                calls['max'] = max(calls['max'], elapsed)
+
+    def state(self):
+        """
+        Phase times, row counts and calls recorded so far, picklable so a
+        worker process can hand them to merge in the parent
+        """
+        with self.lock:
+            return (
+                dict(self.seconds),
+                dict(self.rows),
+                {kind: dict(call) for kind, call in self.calls.items()},
+            )
+
+    def merge(self, state):
+        """
+        Add the state of another instance, e.g. one in a worker process
+        """
+        seconds, rows, calls = state
+        with self.lock:
+            for name, elapsed in seconds.items():
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            self.rows.update(rows)
+            for kind, call in calls.items():
+                merged = self.calls.setdefault(kind, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0})
+                merged['count'] += call['count']
+                merged['errors'] += call['errors']
+                merged['seconds'] += call['seconds']
+                merged['max'] = max(merged['max'], call['max'])
+
+    def report(self):
+        """
+        The metrics recorded so far as a dict ready for JSON
+        """
+        with self.lock:
+            phases = collections.OrderedDict()
+            for name in list(self.seconds) + [name for name in self.rows if name not in self.seconds]:
+                phase = dict()
+                seconds = self.seconds.get(name)
+                if seconds is not None:
+                    phase['seconds'] = round(seconds, 6)
+                if name in self.rows:
+                    phase['rows'] = self.rows[name]
+                    if seconds:
+                        phase['rows_per_second'] = round(self.rows[name] / seconds, 1)
+                phases[name] = phase
+
+            calls = collections.OrderedDict()
+            for kind, call in self.calls.items():
+                calls[kind] = {
+                    'count': call['count'],
+                    'errors': call['errors'],
+                    'seconds': round(call['seconds'], 6),
+                    'mean_ms': round(call['seconds'] / call['count'] * 1000, 3),
+                    'max_ms': round(call['max'] * 1000, 3),
+                }
+
+        return {
+            'seconds': round(time.perf_counter() - self.started, 6),
+            'peak_rss_kb': peak_rss(),
+            'phases': phases,
+            'calls': calls,
+        }
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in KB, or None where unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+# the instance the scripts record on, through the functions below
+current = Metrics()
+phase = current.phase
+count = current.count
+counted = current.counted
+call = current.call
+
+
+def reset():
+    """
+    Record on a fresh instance from now on, e.g. between runs measured
+    separately in one process
+    """
+    global current, phase, count, counted, call
+    current = Metrics()
+    phase = current.phase
+    count = current.count
+    counted = current.counted
+    call = current.call
+    return current
+
+
+def add_arguments(parser):
+    """
+    Add the reporting and profiling options to a script's parser
+    """
+    parser.add_argument(
+        '--metrics',
+        metavar='PATH',
+        help='write phase timings, row rates, peak RSS and call latencies as JSON to PATH, or - for stderr',
+    )
+    parser.add_argument(
+        '--progress',
+        type=float,
+        metavar='SECONDS',
+        help='print row counts and rates to stderr at most every SECONDS',
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='run under cProfile and save the stats to PATH for pstats',
+    )
+    parser.add_argument(
+        '--trace_memory',
+        action='store_true',
+        help='trace allocations with tracemalloc and add the largest sites to the metrics report',
+    )
+
+
+@contextlib.contextmanager
+def session(args):
+    """
+    Apply the options from add_arguments around the body of a script,
+    writing the profile and report when it finishes or exits
+    """
+    current.progress = args.progress
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    try:
+        yield current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        report = current.report()
+        if args.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report['tracemalloc'] = {
+                'peak_kb': peak // 1024,
+                'top': [
+                    {'site': str(stat.traceback), 'kb': stat.size // 1024, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:TRACE_TOP]
+                ],
+            }
+
+        if args.metrics == '-':
+            sys.stderr.write(json.dumps(report, indent=2) + '\n')
+        elif args.metrics:
+            with open(args.metrics, 'w') as outfile:
+                json.dump(report, outfile, indent=2)
+                outfile.write('\n')
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
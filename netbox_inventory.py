@@ -4,108 +4,850 @@
 Generate Ansible inventory from Netbox
 """
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import itertools
 import json
+import os
+import queue
 import requests
+import requests.adapters
 import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
 
+import metrics
 
-def resolve_host(hostname):
+
+# selection of domain names to try, in order of preference
+DOMAINS = [
+    '.atl.example.com',
+    '.dfw.example.com',
+    '.ord.example.com',
+    '.jfk.example.com',
+]
+
+# lookups in flight at once
+DNS_WORKERS = 32
+
+# seconds before a lookup is given up as unresolved
+DNS_TIMEOUT = 5.0
+
+# concurrent NetBox requests, retries of one answered with 429 or 5xx, the
+# first retry delay in seconds, doubled for each retry after it, and the
+# seconds a request may take
+HTTP_WORKERS = 8
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_TIMEOUT = 60.0
+
+# objects requested per page of a NetBox list
+PAGE_SIZE = 1000
+
+# hostnames handed to the resolver at a time as hosts stream in
+RESOLVE_BATCH = 256
+
+# allowance for clock skew between here and NetBox when asking for the
+# objects updated since the last sync
+SYNC_MARGIN = datetime.timedelta(minutes=5)
+
+# seconds a cached resolution is trusted, when it resolved and when not
+DNS_TTL = 24 * 60 * 60
+DNS_NEGATIVE_TTL = 60 * 60
+
+# seconds an inventory snapshot answers --list before a background refresh
+SNAPSHOT_MAX_AGE = 5 * 60
+
+# seconds after which a refresh still holding the snapshot lock is presumed dead
+REFRESH_TIMEOUT = 30 * 60
+
+# getaddrinfo errors saying DNS could not answer rather than that a name
+# does not exist, which are never cached
+DNS_TRANSIENT_ERRORS = {socket.EAI_AGAIN, socket.EAI_FAIL}
+
+# cached resolutions kept, the ones expiring soonest are evicted first
+DNS_CACHE_SIZE = 100000
+
+
+class DNSCache:
     """
-    Attempts to find the fully-qualified domain name of the given hostname
-    based on some hard-coded domain names that apply to your organization
+    Resolutions of short hostnames kept on disk between runs: the winning
+    fully-qualified name, or None when no domain resolved, with the time
+    each expires
+    The cache is discarded when the list of domains it was built for
+    changes, since that changes which domain wins
     """
-    # unify to lowercase
-    hostname = hostname.lower()
-    # selection of domain names to try
-    domains = [
-        '.atl.example.com',
-        '.dfw.example.com',
-        '.ord.example.com',
-        '.jfk.example.com',
-    ]
 
-    if '.' in hostname:
-        # assume name is fully qualified
+    def __init__(self, path, domains=DOMAINS, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, size=DNS_CACHE_SIZE):
+        self.path = path
+        self.domains = list(domains)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.entries = dict()
+
+    def load(self):
         try:
-            socket.gethostbyname(hostname)
-        except:
-            # name was not resolved, but can't try more domains
-            pass
-    else:
-        short = hostname
-        resolved = False
-        for domain in domains:
-            fqdn = short + domain
+            with open(self.path, 'r') as infile:
+                cache = json.load(infile)
+            if cache['domains'] != self.domains:
+                return
+            entries = {name: (fqdn, expires) for name, (fqdn, expires) in cache['entries'].items()}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            sys.stderr.write('Ignoring unreadable DNS cache {path}: {error}\n'.format(path=self.path, error=e))
+            return
+        self.entries = entries
+
+    def save(self):
+        now = time.time()
+        entries = [(name, entry) for name, entry in self.entries.items() if entry[1] > now]
+        if len(entries) > self.size:
+            entries.sort(key=lambda item: item[1][1], reverse=True)
+            del entries[self.size:]
+        cache = {
+            'domains': self.domains,
+            'entries': dict(entries),
+        }
+        # write beside the cache and rename, so an interrupted run keeps the old one
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump(cache, outfile)
+        os.replace(self.path + '.tmp', self.path)
+
+    def get(self, name):
+        """
+        (True, fqdn or None) for an unexpired resolution of name, or
+        (False, None) when it has to be looked up
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry[1] <= time.time():
+            return False, None
+        return True, entry[0]
+
+    def set(self, name, fqdn):
+        ttl = self.ttl if fqdn is not None else self.negative_ttl
+        self.entries[name] = (fqdn, time.time() + ttl)
+
+
+class Resolver:
+    """
+    Find the fully-qualified domain names of many hostnames at once, based
+    on some hard-coded domain names that apply to your organization
+    Every candidate name is looked up concurrently, at most workers at a
+    time across all callers and each for at most timeout seconds
+    Lookups run on one event loop in a background thread, handing the
+    blocking getaddrinfo calls to daemon threads, so a lookup stuck past its
+    timeout neither holds up the ones after it nor the interpreter's exit
+    """
+
+    def __init__(self, domains=DOMAINS, workers=DNS_WORKERS, timeout=DNS_TIMEOUT, cache=None):
+        self.domains = list(domains)
+        self.workers = workers
+        self.timeout = timeout
+        # a DNSCache consulted before looking names up, or None
+        self.cache = cache
+        # event loop, semaphore and lookup threads, started on first use
+        self.lock = threading.Lock()
+        self.loop = None
+        self.semaphore = None
+        self.requests = queue.SimpleQueue()
+        # futures of the lookups that timed out, whose threads were replaced
+        # and exit once the lookup ends
+        self.abandoned = set()
+
+    def candidates(self, hostname):
+        """
+        Names to look up for a lowercase hostname, in order of preference
+        """
+        if '.' in hostname:
+            # assume name is fully qualified, nothing else to try
+            return []
+        return [hostname + domain for domain in self.domains]
+
+    def start(self):
+        """
+        Event loop running the lookups, started along with its threads
+        the first time it is needed
+        """
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                self.semaphore = asyncio.Semaphore(self.workers)
+                self.loop = loop
+                for _ in range(self.workers):
+                    self.start_thread()
+            return self.loop
+
+    def start_thread(self):
+        threading.Thread(target=self.lookup_thread, daemon=True).start()
+
+    def lookup_thread(self):
+        """
+        Look the requested names up one at a time, answering each future on
+        the event loop with None or the error raised
+        """
+        while True:
+            fqdn, future = self.requests.get()
             try:
-                socket.gethostbyname(fqdn)
-                # no exception thrown, so name was resolved
-                resolved = True
-                hostname = fqdn
-                # do not consider other domains
+                socket.getaddrinfo(fqdn, None, family=socket.AF_INET)
+                error = None
+            except OSError as e:
+                error = e
+            self.loop.call_soon_threadsafe(self.answer, future, error)
+            with self.lock:
+                if future in self.abandoned:
+                    self.abandoned.remove(future)
+                    return
+
+    @staticmethod
+    def answer(future, error):
+        # the lookup may have timed out already
+        if future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    async def lookup(self, fqdn):
+        """
+        True when fqdn resolved, False when DNS answered that it does not
+        exist, or None when the lookup timed out or failed otherwise
+        """
+        async with self.semaphore:
+            future = self.loop.create_future()
+            # a thread is free for every lookup holding the semaphore, so
+            # the timeout runs from when the lookup starts
+            self.requests.put((fqdn, future))
+            try:
+                with metrics.call('dns'):
+                    await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                # leave the hung thread behind, starting another in its place
+                with self.lock:
+                    self.abandoned.add(future)
+                self.start_thread()
+                return None
+            except socket.gaierror as e:
+                if e.errno in DNS_TRANSIENT_ERRORS:
+                    return None
+                return False
+            except OSError:
+                return None
+            return True
+
+    async def lookup_all(self, fqdns):
+        results = await asyncio.gather(*(self.lookup(fqdn) for fqdn in fqdns))
+        return dict(zip(fqdns, results))
+
+    def lookup_names(self, fqdns):
+        """
+        Map each name to the result of its lookup; safe to call from several
+        threads at once, which share the workers
+        """
+        if not fqdns:
+            return dict()
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(self.lookup_all(fqdns), loop).result()
+
+    def resolve(self, hostnames):
+        """
+        Map each hostname to its lowercase fully-qualified name, using the
+        first domain in order that resolves, or to the lowercase name as
+        given when none does
+        """
+        names = {hostname: hostname.lower() for hostname in hostnames}
+        found = dict()
+        candidates = dict()
+        for name in set(names.values()):
+            if self.cache is not None and '.' not in name:
+                cached, fqdn = self.cache.get(name)
+                if cached:
+                    found[name] = fqdn or name
+                    continue
+            candidates[name] = self.candidates(name)
+
+        fqdns = sorted({fqdn for fqdns in candidates.values() for fqdn in fqdns})
+        resolved = self.lookup_names(fqdns)
+        for name, fqdns in candidates.items():
+            fqdn = None
+            # whether every domain preferred to the one found, or every
+            # domain when none was, is known not to resolve
+            definitive = True
+            for candidate in fqdns:
+                if resolved[candidate]:
+                    fqdn = candidate
+                    break
+                if resolved[candidate] is None:
+                    definitive = False
+            if self.cache is not None and fqdns and definitive:
+                self.cache.set(name, fqdn)
+            found[name] = fqdn or name
+        return {hostname: found[name] for hostname, name in names.items()}
+
+
+def resolve_host(hostname, resolver=None):
+    """
+    Attempts to find the fully-qualified domain name of the given hostname
+    based on some hard-coded domain names that apply to your organization
+    """
+    if resolver is None:
+        resolver = Resolver()
+    return resolver.resolve([hostname])[hostname]
+
+
+class NetBoxClient:
+    """
+    NetBox API client sharing one keep-alive connection pool between
+    concurrent requests, retrying with exponential backoff when NetBox
+    answers 429 or 5xx
+    Each attempt is timed as an http call
+    """
+
+    def __init__(self, base_url, token, workers=HTTP_WORKERS, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=HTTP_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Authorization': 'Token {token}'.format(token=token),
+        })
+        # each worker may have a page in flight and the next one prefetching
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2 * workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, params=None):
+        """
+        Decoded JSON of a GET of path, relative to the API root
+        """
+        return self.get_url(self.base_url + path, params)
+
+    def get_url(self, url, params=None):
+        """
+        Decoded JSON of a GET of a full URL, such as a next page link
+        """
+        for attempt in range(self.retries + 1):
+            with metrics.call('http'):
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            if response.status_code != 429 and response.status_code < 500 or attempt == self.retries:
                 break
-            except:
-                # name was not resolved
-                pass
+            delay = self.backoff * 2 ** attempt
+            # honour the delay NetBox asks for, when it gives one in seconds
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_objects(self, path, params=None, page_size=PAGE_SIZE):
+        """
+        Yield the objects of a list one at a time, fetching it page_size
+        objects per request by following the next links, the next page
+        being fetched while the current one is consumed
+        """
+        params = [(name, value) for name, value in params or () if name != 'limit']
+        params.append(('limit', page_size))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch:
+            page = prefetch.submit(self.get, path, params)
+            while page is not None:
+                response = page.result()
+                page = None
+                if response.get('next'):
+                    page = prefetch.submit(self.get_url, response['next'])
+                yield from response['results']
 
-    return hostname
+    def close(self):
+        self.session.close()
 
 
-def retrieve_vms(base_url, headers, site):
+class ObjectCache:
     """
-    Retrieve all of the VM objects at a given site in Netbox
+    NetBox objects fetched by earlier runs, kept on disk by query with the
+    time each query was last synced
+    A sync asks NetBox only for the objects of a query updated since then,
+    and reconciles deletions against a brief listing of the ids that still
+    match
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queries = dict()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as infile:
+                queries = json.load(infile)['queries']
+            if not isinstance(queries, dict):
+                raise TypeError('queries is not an object')
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            sys.stderr.write('Ignoring unreadable object cache {path}: {error}\n'.format(path=self.path, error=e))
+            return
+        self.queries = queries
+
+    def save(self):
+        # write beside the cache and rename, so an interrupted run keeps the old one
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'queries': self.queries}, outfile)
+        os.replace(self.path + '.tmp', self.path)
+
+    def sync(self, client, path, params, page_size=PAGE_SIZE):
+        """
+        Bring the objects of one query up to date, yielding them as they
+        arrive: the updated ones, then the cached ones a brief listing shows
+        still match, then any listed but not cached
+        The query's entry is only marked synced once every object has been
+        yielded
+        """
+        params = list(params)
+        key = path + '?' + urllib.parse.urlencode(params)
+        # objects updated while this sync runs are fetched again next time
+        started = datetime.datetime.now(datetime.timezone.utc) - SYNC_MARGIN
+        entry = self.queries.get(key)
+
+        if entry is None:
+            objects = dict()
+            for host in client.iter_objects(path, params, page_size):
+                objects[str(host['id'])] = host
+                yield host
+        else:
+            objects = entry['objects']
+            updated = set()
+            for host in client.iter_objects(path, params + [('last_updated__gte', entry['synced'])], page_size):
+                host_id = str(host['id'])
+                objects[host_id] = host
+                updated.add(host_id)
+                yield host
+
+            listed = set()
+            # ids listed but never fetched, e.g. after an interrupted sync
+            missing = list()
+            for host in client.iter_objects(path, params + [('brief', 1)], page_size):
+                host_id = str(host['id'])
+                listed.add(host_id)
+                if host_id in updated:
+                    continue
+                if host_id in objects:
+                    yield objects[host_id]
+                else:
+                    missing.append(host_id)
+            for host_id in set(objects) - listed:
+                del objects[host_id]
+            missing.sort()
+            for start in range(0, len(missing), page_size):
+                ids = [('id', host_id) for host_id in missing[start:start + page_size]]
+                for host in client.iter_objects(path, params + ids, page_size):
+                    objects[str(host['id'])] = host
+                    yield host
+
+        self.queries[key] = {
+            'synced': started.isoformat(),
+            'objects': objects,
+        }
+
+
+# object lists queried for each kind of host, the field naming its role
+# and the kind rules see it as
+VMS_PATH = '/virtualization/virtual-machines/'
+DEVICES_PATH = '/dcim/devices/'
+ROLE_FIELDS = {
+    VMS_PATH: 'role',
+    DEVICES_PATH: 'device_role',
+}
+KINDS = {
+    VMS_PATH: 'vm',
+    DEVICES_PATH: 'device',
+}
+
+# sites with physical devices, and sites with virtual machine clusters
+# adjust to your site designations
+DEVICE_SITES = ['atl', 'ord', 'jfk', 'dfw']
+VM_SITES = ['ord', 'jfk']
+
+# rules placing hosts in Ansible groups
+# a rule on the name field matches hostnames containing it, a rule on any
+# other field (kind, site, role, tenant, platform, tags) matches a host with
+# that value, by slug or name
+# group and parent names may use {field} for the host's value of a field
+GROUP_RULES = [
+    {'group': '{site}_physical', 'field': 'kind', 'match': 'device', 'parents': ['{site}']},
+    {'group': '{site}_vms', 'field': 'kind', 'match': 'vm', 'parents': ['{site}']},
+    # we encode a hosts "environment" (e.g. production/testing) in the hostname
+    {'group': 'testing', 'field': 'name', 'match': 'tst', 'parents': ['nonproduction']},
+    {'group': 'development', 'field': 'name', 'match': 'dev', 'parents': ['nonproduction']},
+    # for example
+    # {'group': 'databases', 'field': 'role', 'match': 'database'},
+    # {'group': 'tenant_{tenant}', 'field': 'tags', 'match': 'managed'},
+]
+
+# hosts outside the group on the right, directly or through its children,
+# land in the group on the left
+# we assume that everything is production if it's not marked
+DEFAULT_GROUPS = [
+    ('production', 'nonproduction'),
+]
+
+
+def host_query(site):
+    """
+    Query parameters selecting the managed hosts at a site
     We only manage RHEL 6/7 host with Ansible, so adjust as needed
     """
-    vms_path = '/virtualization/virtual-machines/?q=&site={site}&status=1&platform=red-hat-enterprise-linux-6-64-bit&platform=red-hat-enterprise-linux-7-64-bit&limit=0'.format(site=site)
-    vms_response = requests.get(
-        base_url + vms_path,
-        headers=headers,
-    )
-    vms_json = vms_response.json()['results']
-    vms = set()
-    for vm in vms_json:
-        if vm['role'] and vm['role']['name'] == 'Appliance':
+    return [
+        ('q', ''),
+        ('site', site),
+        ('status', 1),
+        ('platform', 'red-hat-enterprise-linux-6-64-bit'),
+        ('platform', 'red-hat-enterprise-linux-7-64-bit'),
+    ]
+
+
+def managed_hosts(objects, role_field):
+    """
+    Yield the objects that are not appliances
+    """
+    for host in objects:
+        if host[role_field] and host[role_field]['name'] == 'Appliance':
             # skip appliances marked as RHEL
             continue
-        name = vm['name']
-        hostname = resolve_host(name)
-        if '.' in hostname:
-            vms.add(hostname)
-    return vms
+        yield host
 
 
-def retrieve_devices(base_url, headers, site):
+def stream_hosts(client, resolver, path, site, page_size=PAGE_SIZE, cache=None):
+    """
+    Hosts of one kind at a site by fully-qualified name, resolving names in
+    batches as their pages arrive, through an ObjectCache when one is given
+    Hosts whose names do not resolve are left out
+    """
+    if cache is not None:
+        objects = cache.sync(client, path, host_query(site), page_size)
+    else:
+        objects = client.iter_objects(path, host_query(site), page_size)
+    objects = metrics.counted('hosts', objects)
+    managed = managed_hosts(objects, ROLE_FIELDS[path])
+    hosts = dict()
+    batch = list(itertools.islice(managed, RESOLVE_BATCH))
+    while batch:
+        with metrics.phase('resolve'):
+            hostnames = resolver.resolve([host['name'] for host in batch])
+        for host in batch:
+            fqdn = hostnames[host['name']]
+            if '.' in fqdn:
+                hosts[fqdn] = host
+        batch = list(itertools.islice(managed, RESOLVE_BATCH))
+    return hosts
+
+
+def retrieve_vms(client, site, resolver=None, page_size=PAGE_SIZE):
+    """
+    Retrieve all of the VM objects at a given site in Netbox
+    """
+    return set(stream_hosts(client, resolver or Resolver(), VMS_PATH, site, page_size))
+
+
+def retrieve_devices(client, site, resolver=None, page_size=PAGE_SIZE):
     """
     Retrieve all of the physical devices at a given site
-    We only manage RHEL 6/7 host with Ansible, so adjust as needed
     """
-    devices_path = '/dcim/devices/?q=&site={site}&status=1&platform=red-hat-enterprise-linux-6-64-bit&platform=red-hat-enterprise-linux-7-64-bit&limit=0'.format(site=site)
-    devices_response = requests.get(
-        base_url + devices_path,
-        headers=headers,
-    )
-    devices_json = devices_response.json()['results']
-    devices = set()
-    for device in devices_json:
-        if device['device_role'] and device['device_role']['name'] == 'Appliance':
-            # skip appliances marked as RHEL
-            continue
-        name = device['name']
-        hostname = resolve_host(name)
-        if '.' in hostname:
-            devices.add(hostname)
-    return devices
+    return set(stream_hosts(client, resolver or Resolver(), DEVICES_PATH, site, page_size))
+
+
+def retrieve_hosts(client, resolver, queries, page_size=PAGE_SIZE, cache=None):
+    """
+    Stream the hosts of every (path, site) query concurrently
+    Returns the hosts by fully-qualified name for each query, in order
+    """
+    with metrics.phase('hosts'), concurrent.futures.ThreadPoolExecutor(max_workers=client.workers) as executor:
+        futures = [
+            executor.submit(stream_hosts, client, resolver, path, site, page_size, cache)
+            for path, site in queries
+        ]
+        return [future.result() for future in futures]
+
+
+def host_fields(fqdn, host, path, site):
+    """
+    Values of each field group rules match a host on
+    Related objects match by slug or name, and tags by either when NetBox
+    returns them as objects
+    """
+    fields = {
+        'name': [fqdn],
+        'kind': [KINDS[path]],
+        'site': [site],
+    }
+    for field, key in (('role', ROLE_FIELDS[path]), ('tenant', 'tenant'), ('platform', 'platform')):
+        value = host.get(key)
+        if value:
+            fields[field] = [value[attribute] for attribute in ('slug', 'name') if value.get(attribute)]
+    tags = list()
+    for tag in host.get('tags') or ():
+        if isinstance(tag, dict):
+            tags.extend(tag[attribute] for attribute in ('slug', 'name') if tag.get(attribute))
+        else:
+            tags.append(tag)
+    if tags:
+        fields['tags'] = tags
+    return fields
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton finding the values of every pattern that occurs
+    in a string in one scan of it, however many patterns there are
+    """
+
+    def __init__(self, patterns):
+        # transitions, failure link and matched values of each state
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [list()]
+        for pattern, value in patterns:
+            state = 0
+            for char in pattern:
+                following = self.goto[state].get(char)
+                if following is None:
+                    following = len(self.goto)
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append(list())
+                    self.goto[state][char] = following
+                state = following
+            self.output[state].append(value)
+
+        # link each state to its longest proper suffix in the automaton,
+        # breadth first so the links of shorter states are set
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[following] = self.goto[fail].get(char, 0)
+                self.output[following] = self.output[following] + self.output[self.fail[following]]
+
+    def search(self, text):
+        found = list()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found.extend(self.output[state])
+        return found
+
+
+class HostGrouper:
+    """
+    Ansible groups built from GROUP_RULES, classifying each host once
+    against every rule: name rules through one PatternMatcher and the
+    rest through a lookup of each of the host's field values
+    """
+
+    def __init__(self, rules=GROUP_RULES, defaults=DEFAULT_GROUPS):
+        self.rules = rules
+        self.defaults = defaults
+        self.names = PatternMatcher(
+            (rule['match'], index)
+            for index, rule in enumerate(rules)
+            if rule['field'] == 'name'
+        )
+        self.values = collections.defaultdict(list)
+        for index, rule in enumerate(rules):
+            if rule['field'] != 'name':
+                self.values[rule['field'], rule['match']].append(index)
+        self.hosts = set()
+        # hosts and child groups by group name
+        self.groups = dict()
+
+    def group(self, name):
+        return self.groups.setdefault(name, {'hosts': set(), 'children': set()})
+
+    def add(self, fqdn, fields):
+        """
+        Place a host in the groups of every rule it matches
+        """
+        self.hosts.add(fqdn)
+        matched = set(self.names.search(fqdn))
+        for field, values in fields.items():
+            for value in values:
+                matched.update(self.values.get((field, value), ()))
+
+        first = {field: values[0] for field, values in fields.items()}
+        for index in matched:
+            rule = self.rules[index]
+            try:
+                name = rule['group'].format(**first)
+                parents = [parent.format(**first) for parent in rule.get('parents', ())]
+            except KeyError:
+                # the host lacks a field the group is named by
+                continue
+            self.group(name)['hosts'].add(fqdn)
+            for parent in parents:
+                self.group(parent)['children'].add(name)
+
+    def members(self, name, seen=None):
+        """
+        Hosts of a group and of its children
+        """
+        seen = set() if seen is None else seen
+        seen.add(name)
+        group = self.groups.get(name, {'hosts': set(), 'children': set()})
+        hosts = set(group['hosts'])
+        for child in group['children']:
+            if child not in seen:
+                hosts |= self.members(child, seen)
+        return hosts
+
+    def finish(self):
+        """
+        Fill the default groups and return the groups by name
+        """
+        for name, unless in self.defaults:
+            self.group(name)['hosts'] |= self.hosts - self.members(unless)
+        return self.groups
+
+
+def host_vars(host, path, site):
+    """
+    Ansible variables of a host from its NetBox fields
+    """
+    hostvars = {
+        'netbox_id': host['id'],
+        'netbox_kind': KINDS[path],
+        'netbox_site': site,
+    }
+    for var, key in (('netbox_role', ROLE_FIELDS[path]), ('netbox_tenant', 'tenant'), ('netbox_platform', 'platform'), ('netbox_status', 'status')):
+        value = host.get(key)
+        if isinstance(value, dict):
+            value = value.get('slug') or value.get('value') or value.get('name')
+        if value is not None:
+            hostvars[var] = value
+    if host.get('primary_ip'):
+        hostvars['netbox_primary_ip'] = host['primary_ip']['address']
+    if host.get('tags'):
+        hostvars['netbox_tags'] = [
+            tag.get('slug') or tag.get('name') if isinstance(tag, dict) else tag
+            for tag in host['tags']
+        ]
+    if host.get('custom_fields'):
+        hostvars['netbox_custom_fields'] = host['custom_fields']
+    return hostvars
+
+
+class Snapshot:
+    """
+    The inventory last built, kept on disk so --list and --host answer
+    without NetBox or DNS
+    A snapshot older than max_age is still served while a refresh in the
+    background rebuilds it
+    """
+
+    def __init__(self, path, max_age=SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.generated = None
+
+    @property
+    def lock_path(self):
+        return self.path + '.lock'
+
+    def load(self):
+        """
+        The inventory in the snapshot, or None when there is no usable one
+        """
+        try:
+            with open(self.path, 'r') as infile:
+                snapshot = json.load(infile)
+            generated = float(snapshot['generated'])
+            inventory = snapshot['inventory']
+            if not isinstance(inventory, dict):
+                raise TypeError('inventory is not an object')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            sys.stderr.write('Ignoring unreadable snapshot {path}: {error}\n'.format(path=self.path, error=e))
+            return None
+        self.generated = generated
+        return inventory
+
+    def stale(self):
+        return self.generated is None or time.time() - self.generated > self.max_age
+
+    def save(self, inventory):
+        # write beside the snapshot and rename, so readers never see half of one
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'generated': time.time(), 'inventory': inventory}, outfile)
+        os.replace(self.path + '.tmp', self.path)
+
+    def start_refresh(self, argv):
+        """
+        Rebuild the snapshot in a detached process running this script with
+        --refresh_snapshot and the other options in argv, unless another
+        refresh holds the lock
+        """
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(self.lock_path) < REFRESH_TIMEOUT:
+                    return
+                os.utime(self.lock_path)
+            except OSError:
+                return
+        except OSError as e:
+            sys.stderr.write('Unable to refresh snapshot {path}: {error}\n'.format(path=self.path, error=e))
+            return
+        else:
+            os.close(fd)
+
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--refresh_snapshot'] + argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def release(self):
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
 
 
-def filter_hosts(hosts, query):
+def refresh_arguments(argv):
     """
-    Simple filter to group hosts by some basic criteria
-    We do short acronyms for site and to designate production/test/etc
+    Options of this invocation to pass to a background refresh, without
+    the --list or --host that asked for the inventory
     """
-    matches = set()
-    for host in hosts:
-        if query in host:
-            matches.add(host)
-    return matches
+    options = list()
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument == '--list' or argument.startswith('--host='):
+            continue
+        if argument == '--host':
+            next(arguments, None)
+            continue
+        options.append(argument)
+    return options
 
 
 def print_hosts(outfile, hosts, environment):
@@ -124,77 +866,219 @@ def main():
     Retrieves all devices and VMs from Netbox and sorts them into specified criteria
     which can be consumed as an Ansible inventory file
     """
-    # setup basic requests portions
+    parser = argparse.ArgumentParser(
+        description='Generate an Ansible inventory file from Netbox',
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--list',
+        action='store_true',
+        help='print the inventory as JSON for Ansible instead of writing hosts.netbox',
+    )
+    mode.add_argument(
+        '--host',
+        type=str,
+        help='print the variables of one host as JSON for Ansible',
+    )
+    mode.add_argument(
+        '--refresh_snapshot',
+        action='store_true',
+        help='rebuild the snapshot --list and --host answer from, e.g. from cron',
+    )
+    parser.add_argument(
+        '--snapshot',
+        type=str,
+        default='inventory_snapshot.json',
+        help='file holding the inventory last built for --list and --host',
+    )
+    parser.add_argument(
+        '--max_age',
+        type=float,
+        default=SNAPSHOT_MAX_AGE,
+        help='seconds before --list or --host refreshes the snapshot in the background',
+    )
     # adjust URL for your instance
-    base_url = 'https://netbox.example.com/api'
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': 'Token your-token-here',
-    }
+    parser.add_argument(
+        '--url',
+        type=str,
+        default='https://netbox.example.com/api',
+        help='Netbox API root',
+    )
+    parser.add_argument(
+        '--token',
+        type=str,
+        default=os.environ.get('NETBOX_TOKEN', 'your-token-here'),
+        help='Netbox API token, by default from NETBOX_TOKEN',
+    )
+    parser.add_argument(
+        '--http_workers',
+        type=int,
+        default=HTTP_WORKERS,
+        help='Netbox requests in flight at once',
+    )
+    parser.add_argument(
+        '--page_size',
+        type=int,
+        default=PAGE_SIZE,
+        help='hosts requested per page from Netbox',
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=HTTP_RETRIES,
+        help='retries of a Netbox request answered with 429 or 5xx',
+    )
+    parser.add_argument(
+        '--object_cache',
+        type=str,
+        default='netbox_objects.json',
+        help='file caching Netbox hosts between runs, so only changes are fetched',
+    )
+    parser.add_argument(
+        '--full_refresh',
+        action='store_true',
+        help='fetch every host again, replacing the cached objects',
+    )
+    parser.add_argument(
+        '--dns_workers',
+        type=int,
+        default=DNS_WORKERS,
+        help='hostname lookups in flight at once',
+    )
+    parser.add_argument(
+        '--dns_timeout',
+        type=float,
+        default=DNS_TIMEOUT,
+        help='seconds before a hostname lookup is treated as unresolved',
+    )
+    parser.add_argument(
+        '--dns_cache',
+        type=str,
+        default='dns_cache.json',
+        help='file caching hostname resolutions between runs',
+    )
+    parser.add_argument(
+        '--dns_ttl',
+        type=float,
+        default=DNS_TTL,
+        help='seconds a cached resolution is trusted',
+    )
+    parser.add_argument(
+        '--dns_negative_ttl',
+        type=float,
+        default=DNS_NEGATIVE_TTL,
+        help='seconds a cached failure to resolve is trusted',
+    )
+    parser.add_argument(
+        '--refresh_dns',
+        '--refresh-dns',
+        action='store_true',
+        help='look every hostname up again, replacing the cached resolutions',
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
 
-    # corresponds to sites with physical devices
-    # adjust to your site designations
-    devices = {
-        'atl': set(),
-        'ord': set(),
-        'jfk': set(),
-        'dfw': set(),
-    }
+    with metrics.session(args):
+        if args.list or args.host is not None:
+            snapshot = Snapshot(args.snapshot, max_age=args.max_age)
+            inventory = snapshot.load()
+            if inventory is None:
+                inventory = collect_inventory(args)
+                save_snapshot(snapshot, inventory)
+            elif snapshot.stale():
+                snapshot.start_refresh(refresh_arguments(sys.argv[1:]))
 
-    # corresponds to sites with virtual machine clusters
-    # adjust to your site designations
-    vms = {
-        'ord': set(),
-        'jfk': set(),
-    }
+            if args.host is not None:
+                inventory = inventory.get('_meta', {}).get('hostvars', {}).get(args.host, {})
+            json.dump(inventory, sys.stdout)
+            sys.stdout.write('\n')
+        elif args.refresh_snapshot:
+            snapshot = Snapshot(args.snapshot, max_age=args.max_age)
+            try:
+                save_snapshot(snapshot, collect_inventory(args))
+            finally:
+                snapshot.release()
+        else:
+            write_inventory(collect_inventory(args))
 
-    sites = devices.keys()
 
-    for site in devices.keys():
-        devices[site] = retrieve_devices(base_url, headers, site)
+def collect_inventory(args):
+    """
+    Build the inventory from Netbox through the caches named in args,
+    saving the caches afterwards
+    """
+    cache = DNSCache(args.dns_cache, ttl=args.dns_ttl, negative_ttl=args.dns_negative_ttl)
+    if not args.refresh_dns:
+        cache.load()
+    objects = ObjectCache(args.object_cache)
+    if not args.full_refresh:
+        objects.load()
 
-    for site in vms.keys():
-        vms[site] = retrieve_vms(base_url, headers, site)
+    client = NetBoxClient(args.url, args.token, workers=args.http_workers, retries=args.retries)
+    try:
+        resolver = Resolver(workers=args.dns_workers, timeout=args.dns_timeout, cache=cache)
+        inventory = build_inventory(client, resolver, args.page_size, objects)
+    except requests.RequestException as e:
+        sys.exit('Error retrieving hosts from Netbox: {error}'.format(error=e))
+    finally:
+        client.close()
+    for saved in (cache, objects):
+        try:
+            saved.save()
+        except OSError as e:
+            sys.stderr.write('Unable to save {path}: {error}\n'.format(path=saved.path, error=e))
+    return inventory
 
-    all_hosts = set()
-    for device_set in devices.values():
-        all_hosts |= device_set
-    for vm_set in vms.values():
-        all_hosts |= vm_set
 
-    # we encode a hosts "environment" (e.g. production/testing) in the hostname
-    # so we filter based on those matches
-    test_hosts = filter_hosts(all_hosts, 'tst')
-    dev_hosts = filter_hosts(all_hosts, 'dev')
-    nonprd_hosts = test_hosts | dev_hosts
-    # we assume that everything is production if it's not marked
-    prd_hosts = all_hosts - nonprd_hosts
-
-    # we output to ./hosts.netbox by default - sorry, I'll setup a fancier argparse sometime
-    with open('hosts.netbox', 'w') as outfile:
-        for site in sorted(sites):
-            outfile.write('[{site}:children]\n{site}_physical\n'.format(site=site))
-            if site in vms.keys():
-                outfile.write('{site}_vms\n'.format(site=site))
-
-            outfile.write('\n[{site}]\n\n'.format(site=site))
-
-            outfile.write('[{site}_physical]\n'.format(site=site))
-            for device in sorted(devices[site]):
-                outfile.write(device + '\n')
-            outfile.write('\n')
-
-            if site in vms.keys():
-                outfile.write('[{site}_vms]\n'.format(site=site))
-                for vm in sorted(vms[site]):
-                    outfile.write(vm + '\n')
+def save_snapshot(snapshot, inventory):
+    try:
+        snapshot.save(inventory)
+    except OSError as e:
+        sys.stderr.write('Unable to save {path}: {error}\n'.format(path=snapshot.path, error=e))
+
+
+def build_inventory(client, resolver, page_size=PAGE_SIZE, cache=None):
+    """
+    Retrieve the hosts and group them
+    Returns the inventory as Ansible expects it from --list: each group's
+    hosts and children, and the variables of each host under _meta
+    """
+    # every site and kind of host is fetched at once
+    queries = [(DEVICES_PATH, site) for site in DEVICE_SITES] + [(VMS_PATH, site) for site in VM_SITES]
+    hosts = retrieve_hosts(client, resolver, queries, page_size, cache)
+
+    grouper = HostGrouper()
+    hostvars = dict()
+    with metrics.phase('group'):
+        for (path, site), site_hosts in zip(queries, hosts):
+            for fqdn, host in site_hosts.items():
+                grouper.add(fqdn, host_fields(fqdn, host, path, site))
+                hostvars[fqdn] = host_vars(host, path, site)
+        groups = grouper.finish()
+
+    inventory = {
+        name: {'hosts': sorted(group['hosts']), 'children': sorted(group['children'])}
+        for name, group in sorted(groups.items())
+    }
+    inventory['_meta'] = {'hostvars': hostvars}
+    return inventory
+
+
+def write_inventory(inventory, path='hosts.netbox'):
+    """
+    Write the groups of an inventory as an INI file, ./hosts.netbox by default
+    """
+    with open(path, 'w') as outfile:
+        for name, group in inventory.items():
+            if name == '_meta':
+                continue
+            if group['children']:
+                outfile.write('[{name}:children]\n'.format(name=name))
+                for child in group['children']:
+                    outfile.write(child + '\n')
                 outfile.write('\n')
-        
-        # go through and output all groups
-        print_hosts(outfile, test_hosts, 'testing')
-        print_hosts(outfile, dev_hosts, 'development')
-        print_hosts(outfile, nonprd_hosts, 'nonproduction')
-        print_hosts(outfile, prd_hosts, 'production')
+            if group['hosts']:
+                print_hosts(outfile, group['hosts'], name)
 
 
 if __name__ == '__main__':
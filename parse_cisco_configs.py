@@ -6,113 +6,363 @@ Parse Cisco router configs for vlans and addresses
 
 import argparse
 import csv
+import functools
 import ipaddress
+import multiprocessing
 import os
 import re
+import socket
 import sys
 
+import columnar
+import metrics
+
+
+# interface line, split into its kind, e.g. GigabitEthernet or Vlan, its
+# port and any subinterface number
+RE_INTERFACE = re.compile(r'interface (?P<name>(?P<kind>[A-Za-z-]+)(?P<port>[0-9/:]+)(?:\.(?P<sub>\d+))?)$')
+RE_IPV4 = re.compile(r'ip address (?P<address>[0-9.]+) (?P<netmask>[0-9.]+)(?P<secondary> secondary)?$')
+RE_IPV6 = re.compile(r'ipv6 address (?P<address>[0-9A-Fa-f:/]+)$')
+RE_DOT1Q = re.compile(r'encapsulation dot1Q (?P<vid>\d+)(?: native)?$', re.IGNORECASE)
+
+# interface kinds that carry a routed subnet without a VLAN of their own
+ROUTED_KINDS = {
+    'Ethernet',
+    'FastEthernet',
+    'GigabitEthernet',
+    'TenGigabitEthernet',
+    'TwentyFiveGigE',
+    'FortyGigabitEthernet',
+    'HundredGigE',
+    'Port-channel',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def netmask_length(netmask):
+    """
+    Prefix length of a dotted netmask, parsed once for the few a config uses
+    """
+    return ipaddress.IPv4Network('0.0.0.0/' + netmask).prefixlen
+
+
+def ipv4_interface(address, netmask):
+    """
+    Network and gateway with prefix length of an IPv4 interface address,
+    computed on the packed address rather than through ipaddress objects
+    """
+    try:
+        packed = socket.inet_pton(socket.AF_INET, address)
+    except OSError:
+        raise ValueError('{address} does not appear to be an IPv4 address'.format(address=address))
+    length = netmask_length(netmask)
+    mask = (0xffffffff << (32 - length)) & 0xffffffff
+    network = (int.from_bytes(packed, 'big') & mask).to_bytes(4, 'big')
+    return (
+        '{network}/{length}'.format(network=socket.inet_ntoa(network), length=length),
+        '{address}/{length}'.format(address=socket.inet_ntoa(packed), length=length),
+    )
+
+
+class ConfigParser:
+    """
+    Single pass over a Cisco config, dispatching each line on its first
+    word to at most one handler that matches it once
+    Top-level lines other than interface end the interface block, so only
+    indented lines inside it are dispatched
+    Each block becomes a row when it ends: SVIs and dot1Q subinterfaces as
+    VLANs, routed physical interfaces and subinterfaces with addresses
+    with an empty vid
+    """
+
+    def __init__(self, site, device):
+        self.site = site.upper()
+        self.device = device
+        self.interface = None
+        self.rows = list()
+        self.handlers = {
+            'description': self.description,
+            'ip': self.ipv4_address,
+            'ipv6': self.ipv6_address,
+            'encapsulation': self.encapsulation,
+        }
+
+    def parse(self, config):
+        handlers = self.handlers
+        for line in config:
+            if line[:1] not in ' \t':
+                # a top-level line, or a blank one
+                if line.startswith('interface '):
+                    self.end()
+                    self.start(line.rstrip())
+                elif not line.isspace():
+                    self.end()
+            elif self.interface is not None:
+                stripped = line.strip()
+                handler = handlers.get(stripped.partition(' ')[0])
+                if handler is not None:
+                    handler(stripped)
+        self.end()
+        return self.rows
+
+    def start(self, line):
+        match = RE_INTERFACE.match(line)
+        if not match:
+            return
+        self.interface = {
+            'name': match.group('name'),
+            'kind': match.group('kind'),
+            # an SVI's VLAN, or a subinterface's from its encapsulation
+            'vid': match.group('port') if match.group('kind') == 'Vlan' and not match.group('sub') else None,
+            'description': None,
+            'ipv4': None,
+            'secondary': list(),
+            'ipv6': None,
+        }
+
+    def description(self, line):
+        self.interface['description'] = line[len('description '):]
+
+    def ipv4_address(self, line):
+        match = RE_IPV4.match(line)
+        if not match:
+            return
+        address = match.group('address')
+        netmask = match.group('netmask')
+        try:
+            ip_info = ipv4_interface(address, netmask)
+        except ValueError as e:
+            raise ValueError(
+                'Exception converting {address}/{netmask} to IP: {error}'.format(
+                    address=address,
+                    netmask=netmask,
+                    error=e,
+                )
+            )
+        if match.group('secondary'):
+            self.interface['secondary'].append(ip_info)
+        else:
+            self.interface['ipv4'] = ip_info
+
+    def ipv6_address(self, line):
+        match = RE_IPV6.match(line)
+        if not match:
+            return
+        address = match.group('address')
+        try:
+            self.interface['ipv6'] = ipaddress.ip_interface(address)
+        except ValueError as e:
+            raise ValueError(
+                'Exception converting {address} to IP: {error}'.format(
+                    address=address,
+                    error=e,
+                )
+            )
+
+    def encapsulation(self, line):
+        match = RE_DOT1Q.match(line)
+        if match and self.interface['vid'] is None:
+            self.interface['vid'] = match.group('vid')
+
+    def end(self):
+        interface = self.interface
+        if interface is None:
+            return
+        self.interface = None
+
+        vid = interface['vid']
+        addressed = interface['ipv4'] or interface['secondary'] or interface['ipv6']
+        if vid is None and (interface['kind'] not in ROUTED_KINDS or not addressed):
+            return
+        row = {
+            'site': self.site,
+            'group_name': self.device,
+            'vid': vid or '',
+            'name': '{device}-v{vid}'.format(device=self.device, vid=vid) if vid else '{device}-{interface}'.format(device=self.device, interface=interface['name']),
+            'tenant': '',
+            'status': 'Active',
+            'role': '',
+            'interface': interface['name'],
+        }
+        if interface['description'] is not None:
+            row['description'] = interface['description']
+        if interface['ipv4'] is not None:
+            row['ipv4_network'], row['ipv4_gateway'] = interface['ipv4']
+        if interface['secondary']:
+            row['ipv4_secondary'] = ' '.join(gateway for _, gateway in interface['secondary'])
+        if interface['ipv6'] is not None:
+            row['ipv6_network'] = str(interface['ipv6'].network)
+            row['ipv6_gateway'] = interface['ipv6'].with_prefixlen
+        self.rows.append(row)
+
 
 def parse_vlans(config, site, device):
     """
+    Raises ValueError for an address that does not convert
     Example config section:
         interface TenGigabitEthernet6/5
          description rtr-example-xe-0-3-6
          ip address 198.51.100.1 255.255.255.254
          ipv6 address 2001:db8:dead::beef/127
         !
+        interface TenGigabitEthernet6/6.120
+         encapsulation dot1Q 120
+         ip address 198.51.100.9 255.255.255.248
+        !
         interface Vlan60
          description another-example
          ip address 192.0.2.1 255.255.255.192
+         ip address 192.0.2.129 255.255.255.192 secondary
          ipv6 address 2001:db8:beef:dead::1/64
         !
     """
-    # setup regex
-    re_vid = re.compile(r'^\s*interface Vlan(?P<vid>\d+)$')
-    #re_interface = re.compile(r'^\s*interface (?P<interface>(Loopback|FastEthernet|GigabitEthernet|TenGigabitEthernet)[0-9/]+)$')
-    re_desc = re.compile(r'^\s*description (?P<desc>[\w./-]+)$')
-    re_ipv4 = re.compile(r'^\s*ip address (?P<address>[0-9.]+) (?P<netmask>[0-9.]+)$')
-    re_ipv6 = re.compile(r'^\s*ipv6 address (?P<address>[0-9A-Fa-f:/]+)$')
-    re_end = re.compile(r'^\s*!$')
-    re_blank = re.compile(r'^\s*$')
-
-    # flag if in vlan block
-    vlan_block = False
-
-    # create empty dict for scoping issues
-    vlan = dict()
-    vlans = list()
-    for line in config:
-        # skip blank lines
-        if re_blank.match(line):
-            continue
-
-        # reset vlan block flag and continue
-        if re_end.match(line):
-            vlan_block = False
-            continue
-
-        # check if opening new unit block
-        if re_vid.match(line):
-            # set flag that we've entered a vlan block
-            vlan_block = True
-            # in a new unit block, pull out vlan id
-            vid = re_vid.match(line).group('vid')
-            name = '{device}-v{vid}'.format(
-                device=device,
-                vid=vid,
-            )
-            # store known information in new dict
-            vlan = {
-                'site': site.upper(),
-                'group_name': device,
-                'vid': vid,
-                'name': name,
-                'tenant': '',
-                'status': 'Active',
-                'role': '',
-            }
-            # add new dict to list
-            vlans.append(vlan)
-
-        # only want to check the following when in a vlan block
-        if vlan_block:
-            # check if setting description
-            if re_desc.match(line):
-                vlan['description'] = re_desc.match(line).group('desc')
-            # check if setting address
-            elif re_ipv4.match(line):
-                address = re_ipv4.match(line).group('address')
-                netmask = re_ipv4.match(line).group('netmask')
-                try:
-                    ip_info = ipaddress.ip_interface(
-                        '{address}/{netmask}'.format(
-                            address=address,
-                            netmask=netmask,
-                        )
-                    )
-                    vlan['ipv4_network'] = str(ip_info.network)
-                    vlan['ipv4_gateway'] = ip_info.with_prefixlen
-                except ValueError as e:
-                    print(
-                        'Exception converting {address}/{netmask} to IP'.format(
-                            address=address,
-                            netmask=netmask,
-                        )
-                    )
-                    sys.exit(str(e))
-            elif re_ipv6.match(line):
-                address = re_ipv6.match(line).group('address')
-                try:
-                    ip_info = ipaddress.ip_interface(address)
-                    vlan['ipv6_network'] = str(ip_info.network)
-                    vlan['ipv6_gateway'] = ip_info.with_prefixlen
-                except ValueError as e:
-                    print('Exception converting {address} to IP'.format(address=address))
-                    sys.exit(str(e))
-    return vlans
-
-
-def write_vlans(vlans, site, device, output_file):
+    return ConfigParser(site, device).parse(config)
+
+
+# output columns and their types when written as a columnar table
+VLAN_SCHEMA = [
+    ('site', 'str'),
+    ('group_name', 'str'),
+    ('vid', 'int'),
+    ('name', 'str'),
+    ('tenant', 'str'),
+    ('status', 'str'),
+    ('role', 'str'),
+    ('description', 'str'),
+    ('interface', 'str'),
+    ('ipv4_network', 'ip'),
+    ('ipv4_gateway', 'ip'),
+    ('ipv4_secondary', 'str'),
+    ('ipv6_network', 'ip'),
+    ('ipv6_gateway', 'ip'),
+]
+
+
+# columns of the error records written in batch mode
+ERROR_FIELDS = [
+    'path',
+    'site',
+    'device',
+    'error',
+]
+
+# hostname set in a config, naming the device in batch mode
+RE_HOSTNAME = re.compile(r'^hostname (?P<hostname>\S+)$')
+
+# leading acronym of a device name taken as its site in batch mode
+SITE_PATTERN = r'^(?P<site>[A-Za-z]{3})'
+
+# configs handed to a worker at a time in batch mode
+BATCH_CHUNK = 8
+
+
+def config_files(directory=None, manifest=None):
+    """
+    Yield (path, site, device) of the configs in a directory, or listed in
+    a manifest as lines of a path, optionally followed by site and device
+    Paths in a manifest are relative to it; site and device not given are
+    None, to be derived from the config
+    """
+    if directory is not None:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.startswith('.'):
+                yield path, None, None
+        return
+
+    base = os.path.dirname(manifest)
+    with open(manifest, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            fields += [None] * (3 - len(fields))
+            yield os.path.join(base, fields[0]), fields[1], fields[2]
+
+
+def config_names(lines, path, site_pattern=SITE_PATTERN):
+    """
+    Site and device of a config: the device from its hostname line, or the
+    file name without extension, and the site from the part of the device
+    name matching site_pattern
+    """
+    device = None
+    for line in lines:
+        match = RE_HOSTNAME.match(line.rstrip())
+        if match:
+            device = match.group('hostname')
+            break
+    if device is None:
+        device = os.path.splitext(os.path.basename(path))[0]
+    match = re.search(site_pattern, device)
+    # a pattern without a site group, or whose site group took no part in
+    # the match, fails this config rather than the batch
+    site = match.groupdict().get('site') if match else None
+    if not site:
+        raise ValueError('Unable to derive a site from device {device}'.format(device=device))
+    return site, device
+
+
+def parse_file(task):
+    """
+    Parse one config in a worker process
+    Returns (VLAN rows, error record), one of which is None, so a failing
+    config does not stop the batch
+    """
+    path, site, device, site_pattern = task
+    try:
+        with open(path, 'r') as infile:
+            lines = infile.readlines()
+        if len(lines) == 0:
+            raise ValueError('{path} is empty'.format(path=path))
+        if site is None or device is None:
+            derived_site, derived_device = config_names(lines, path, site_pattern)
+            site = site or derived_site
+            device = device or derived_device
+        return parse_vlans(lines, site, device), None
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        return None, {
+            'path': path,
+            'site': site or '',
+            'device': device or '',
+            'error': str(e),
+        }
+
+
+def parse_batch(files, workers, site_pattern=SITE_PATTERN):
+    """
+    Parse configs across a pool of worker processes, yielding their VLAN
+    rows in file order as they are parsed and collecting error records for
+    the configs that fail in the returned list
+    """
+    errors = list()
+
+    def rows():
+        tasks = ((path, site, device, site_pattern) for path, site, device in files)
+        with multiprocessing.Pool(workers) as pool:
+            for vlans, error in pool.imap(parse_file, tasks, BATCH_CHUNK):
+                metrics.count('files')
+                if error is not None:
+                    errors.append(error)
+                    continue
+                yield from vlans
+
+    return rows(), errors
+
+
+def write_errors(errors, output_file):
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=ERROR_FIELDS, dialect='unix')
+        writer.writeheader()
+        writer.writerows(errors)
+
+
+def write_vlans(vlans, site, device, output_file, output_format='csv'):
+    if output_format == 'columnar':
+        output_file = os.path.splitext(output_file)[0] + columnar.EXTENSION
+        columnar.write_table(output_file, VLAN_SCHEMA, vlans)
+        return
+
     with open(output_file, 'w', newline='') as csvfile:
         fieldnames = [
             'site',
@@ -123,8 +373,10 @@ def write_vlans(vlans, site, device, output_file):
             'status',
             'role',
             'description',
+            'interface',
             'ipv4_network',
             'ipv4_gateway',
+            'ipv4_secondary',
             'ipv6_network',
             'ipv6_gateway',
         ]
@@ -154,15 +406,87 @@ def main():
     parser.add_argument(
         'site',
         type=str,
-        help='Netbox site',
+        nargs='?',
+        help='Netbox site, derived from each config in batch mode',
     )
     parser.add_argument(
         'device',
         type=str,
-        help='name of device',
+        nargs='?',
+        help='name of device, derived from each config in batch mode',
+    )
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument(
+        '-d',
+        '--directory',
+        type=str,
+        help='parse every config in this directory into one output',
+    )
+    batch.add_argument(
+        '-m',
+        '--manifest',
+        type=str,
+        help='parse the configs listed in this file, one path per line optionally followed by site and device',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='processes parsing configs at once in batch mode',
+    )
+    parser.add_argument(
+        '--site_pattern',
+        type=str,
+        default=SITE_PATTERN,
+        help='regex whose site group picks the site out of a device name in batch mode',
+    )
+    parser.add_argument(
+        '-e',
+        '--errors_file',
+        type=str,
+        default='routers_errors.csv',
+        help='location for the error records of configs that fail in batch mode',
     )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=['csv', 'columnar'],
+        default='csv',
+        help='write CSV, or a typed columnar table beside the output file',
+    )
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.directory or args.manifest:
+        try:
+            site_pattern = re.compile(args.site_pattern)
+        except re.error as e:
+            parser.error('--site_pattern: {error}'.format(error=e))
+        if 'site' not in site_pattern.groupindex:
+            parser.error('--site_pattern: no site group, e.g. (?P<site>...)')
+        with metrics.session(args):
+            try:
+                files = list(config_files(args.directory, args.manifest))
+            except OSError as e:
+                sys.exit('Unable to list configs: {error}'.format(error=e))
+            with metrics.phase('parse'):
+                vlans, errors = parse_batch(files, args.workers, args.site_pattern)
+                write_vlans(metrics.counted('parse', vlans), args.site, args.device, args.output_file, args.format)
+            write_errors(errors, args.errors_file)
+        if errors:
+            sys.stderr.write(
+                '{count} of {total} configs failed, see {errors_file}\n'.format(
+                    count=len(errors),
+                    total=len(files),
+                    errors_file=args.errors_file,
+                )
+            )
+        return
+
+    if args.site is None or args.device is None:
+        parser.error('site and device are required without --directory or --manifest')
+
     lines = list()
     with open(args.input_file, 'r') as infile:
         lines = infile.readlines()
@@ -173,8 +497,14 @@ def main():
             )
         )
 
-    vlans = parse_vlans(lines, args.site, args.device)
-    write_vlans(vlans, args.site, args.device, args.output_file)
+    with metrics.session(args):
+        with metrics.phase('parse'):
+            try:
+                vlans = parse_vlans(metrics.counted('parse', lines), args.site, args.device)
+            except ValueError as e:
+                sys.exit(str(e))
+        with metrics.phase('write'):
+            write_vlans(vlans, args.site, args.device, args.output_file, args.format)
 
 
 if __name__ == '__main__':
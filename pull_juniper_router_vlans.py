@@ -15,11 +15,15 @@ import re
 import socket
 import sys
 
+import columnar
+import metrics
+
 
 def pull_config(device, user, password):
     try:
         # retrieve IP from hostname
-        ip = socket.gethostbyname(device)
+        with metrics.call('dns'):
+            ip = socket.gethostbyname(device)
         conn_info = {
             'device_type': 'juniper_junos',
             'ip': ip,
@@ -27,10 +31,13 @@ def pull_config(device, user, password):
             'password': password,
         }
 
-        net_connect = netmiko.ConnectHandler(**conn_info)
+        with metrics.call('ssh'):
+            net_connect = netmiko.ConnectHandler(**conn_info)
         # at some point, vlans became irbs, so try both and concatenate them
-        irbs = net_connect.send_command('show configuration interfaces irb')
-        vlans = net_connect.send_command('show configuration interfaces vlan')
+        with metrics.call('ssh'):
+            irbs = net_connect.send_command('show configuration interfaces irb')
+        with metrics.call('ssh'):
+            vlans = net_connect.send_command('show configuration interfaces vlan')
         return irbs + vlans
 
     except socket.gaierror as e:
@@ -117,7 +124,29 @@ def parse_vlans(device, config):
     return vlans
 
 
-def write_vlans(vlans, output_file):
+# output columns and their types when written as a columnar table
+VLAN_SCHEMA = [
+    ('site', 'str'),
+    ('group_name', 'str'),
+    ('vid', 'int'),
+    ('name', 'str'),
+    ('tenant', 'str'),
+    ('status', 'str'),
+    ('role', 'str'),
+    ('description', 'str'),
+    ('ipv4_network', 'ip'),
+    ('ipv4_gateway', 'ip'),
+    ('ipv6_network', 'ip'),
+    ('ipv6_gateway', 'ip'),
+]
+
+
+def write_vlans(vlans, output_file, output_format='csv'):
+    if output_format == 'columnar':
+        output_file = os.path.splitext(output_file)[0] + columnar.EXTENSION
+        columnar.write_table(output_file, VLAN_SCHEMA, vlans)
+        return
+
     with open(output_file, 'w', newline='') as csvfile:
         fieldnames = [
             'site',
@@ -163,6 +192,14 @@ def main():
         default='routers_vlans.csv',
         help='location for output file ',
     )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=['csv', 'columnar'],
+        default='csv',
+        help='write CSV, or a typed columnar table beside the output file',
+    )
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     devices = list()
@@ -179,12 +216,16 @@ def main():
 
     password = getpass.getpass('Password for {user}: '.format(user=args.user))
 
-    vlans = list()
-    for device in devices:
-        device = device.lower().strip()
-        config = pull_config(device, args.user, password)
-        vlans.extend(parse_vlans(device, config))
-    write_vlans(vlans, args.output_file)
+    with metrics.session(args):
+        vlans = list()
+        for device in metrics.counted('devices', devices, batch=1):
+            device = device.lower().strip()
+            with metrics.phase('poll'):
+                config = pull_config(device, args.user, password)
+            with metrics.phase('parse'):
+                vlans.extend(parse_vlans(device, config))
+        with metrics.phase('write'):
+            write_vlans(vlans, args.output_file, args.format)
 
 
 if __name__ == '__main__':
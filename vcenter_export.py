@@ -11,6 +11,8 @@ import os
 import re
 import sys
 
+import metrics
+
 
 def parse_vms(vms, site, input_file):
     #fieldnames = [
@@ -55,7 +57,7 @@ def parse_vms(vms, site, input_file):
     with open(input_file, 'r', newline='') as csvfile:
         reader = csv.DictReader(csvfile, dialect='unix')
 
-        for vm in reader:
+        for vm in metrics.counted('parse', reader):
             print(
                 vm['Name'],
                 vm['State'],
@@ -108,6 +110,7 @@ def main():
         type=str,
         help='Netbox site',
     )
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     lines = list()
@@ -120,7 +123,8 @@ def main():
             )
         )
 
-    vms = parse_vms(lines, args.site, args.input_file)
+    with metrics.session(args), metrics.phase('parse'):
+        vms = parse_vms(lines, args.site, args.input_file)
     #write_vms(vms, args.output_file)
 
 